@@ -5,14 +5,17 @@
 import time
 
 from anki.cards import Card
+from anki.notes import Note
 from anki.consts import *
 from anki.hooks import addHook
 from anki.lang import FormatTimeSpan as FormatTimeSpanContext
 
 from aqt import *
-from aqt.operations.card import set_card_flag
 from aqt.utils import askUser, tr
 
+from .review_stats import reviewStats
+from .sort_tables import sortTables, deckSignature
+
 
 class AdvancedFields:
 
@@ -24,183 +27,199 @@ class AdvancedFields:
         # Store a list of CustomColumns managed by this module. We later
         # use this to build our part of the context menu.
         self.customColumns = []
-
-        # Convenience method to create lambdas without scope clobbering
-        def getOnSort(f): return lambda: f
+        self.advBrowser = advBrowser
+
+        def isNotesMode():
+            return advBrowser.table._state.is_notes_mode()
+
+        # Sorting by a revlog column reads the review statistics table,
+        # so bring it up to date first.
+        def refreshReviewStats():
+            reviewStats.refresh()
+            if isNotesMode():
+                reviewStats.refreshNotes()
+
+        def revlogSort(expression, default=None):
+            return lambda: reviewStats.sortClause(expression, default, isNotesMode())
+
+        # Times are stored in milliseconds, but searched in seconds, e.g.
+        # adv:cavgtime>20
+        def secondsToMs(value):
+            if isinstance(value, (int, float)):
+                return value * 1000
+            return value
+
+        # Revlog columns are displayed from the tables they are sorted by,
+        # read in the background. format(stats) returns the value of a
+        # card from its RevlogStats.
+        def revlogBatch(format):
+            def onDataBatch(db, ids, isNotesMode, t):
+                stats = reviewStats.readStats(ids, isNotesMode)
+                return {id: format(s) for id, s in stats.items()}
+            return onDataBatch
 
         # -- Columns -- #
 
         # First review
-        def cFirstOnData(c, n, t):
-            first = mw.col.db.scalar(
-                "select min(id) from revlog where cid = ?", c.id)
+        def cFirstOnData(stats):
+            first = stats.first
             if first:
                 return time.strftime("%Y-%m-%d", time.localtime(first / 1000))
 
         cc = advBrowser.newCustomColumn(
             type='cfirst',
             name='First Review',
-            onData=cFirstOnData,
-            onSort=lambda: "(select min(id) from revlog where cid = c.id) asc nulls last",
+            onData=None,
+            onDataBatch=revlogBatch(cFirstOnData),
+            deferred=True,
+            cache=("revlog",),
+            sortTableFunction=refreshReviewStats,
+            onSort=revlogSort("first"),
         )
         self.customColumns.append(cc)
         # ------------------------------- #
 
         # Last review
-        def cLastOnData(c, n, t):
-            last = mw.col.db.scalar(
-                "select max(id) from revlog where cid = ?", c.id)
+        def cLastOnData(stats):
+            last = stats.last
             if last:
                 return time.strftime("%Y-%m-%d", time.localtime(last / 1000))
 
         cc = advBrowser.newCustomColumn(
             type='clast',
             name='Last Review',
-            onData=cLastOnData,
-            onSort=lambda: "(select max(id) from revlog where cid = c.id) asc nulls last"
+            onData=None,
+            onDataBatch=revlogBatch(cLastOnData),
+            deferred=True,
+            cache=("revlog",),
+            sortTableFunction=refreshReviewStats,
+            onSort=revlogSort("last"),
         )
         self.customColumns.append(cc)
         # ------------------------------- #
 
         # Average time
-        def cAvgtimeOnData(c, n, t):
-            avgtime = mw.col.db.scalar(
-                "select avg(time)/1000.0 from revlog where cid = ?", c.id)
+        def cAvgtimeOnData(stats):
+            avgtime = stats.avgTime
             if avgtime:
-                return mw.col.format_timespan(avgtime)
+                return mw.col.format_timespan(avgtime/1000.0)
             return None
 
         cc = advBrowser.newCustomColumn(
             type='cavgtime',
             name='Time (Average)',
-            onData=cAvgtimeOnData,
-            onSort=lambda: "(select avg(time) from revlog where cid = c.id) asc nulls last"
+            onData=None,
+            onDataBatch=revlogBatch(cAvgtimeOnData),
+            deferred=True,
+            cache=("revlog",),
+            sortTableFunction=refreshReviewStats,
+            onSort=revlogSort("totTime * 1.0 / cnt"),
+            searchValue=secondsToMs,
         )
         self.customColumns.append(cc)
         # ------------------------------- #
 
         # Total time
-        def cTottimeOnData(c, n, t):
-            tottime = mw.col.db.scalar(
-                "select sum(time)/1000.0 from revlog where cid = ?", c.id)
+        def cTottimeOnData(stats):
+            tottime = stats.totTime
             if tottime:
-                return mw.col.format_timespan(tottime)
+                return mw.col.format_timespan(tottime/1000.0)
             return None
 
         cc = advBrowser.newCustomColumn(
             type='ctottime',
             name='Time (Total)',
-            onData=cTottimeOnData,
-            onSort=lambda: "(select sum(time) from revlog where cid = c.id) asc nulls last"
+            onData=None,
+            onDataBatch=revlogBatch(cTottimeOnData),
+            deferred=True,
+            cache=("revlog",),
+            sortTableFunction=refreshReviewStats,
+            onSort=revlogSort("totTime"),
+            searchValue=secondsToMs,
         )
         self.customColumns.append(cc)
         # ------------------------------- #
 
         # Fastest time
-        def cFasttimeOnData(c, n, t):
-            tm = mw.col.db.scalar(
-                "select time/1000.0 from revlog where cid = ? "
-                "order by time asc limit 1", c.id)
+        def cFasttimeOnData(stats):
+            tm = stats.fastTime
             if tm:
-                return mw.col.format_timespan(tm)
+                return mw.col.format_timespan(tm/1000.0)
             return None
 
-        # Note: capital ASC required to avoid search+replace
-        srt = ("(select time/1000.0 from revlog where cid = c.id "
-               "order by time ASC limit 1) asc nulls last")
-
         cc = advBrowser.newCustomColumn(
             type='cfasttime',
             name='Fastest Review',
-            onData=cFasttimeOnData,
-            onSort=getOnSort(srt)
+            onData=None,
+            onDataBatch=revlogBatch(cFasttimeOnData),
+            deferred=True,
+            cache=("revlog",),
+            sortTableFunction=refreshReviewStats,
+            onSort=revlogSort("fastTime"),
+            searchValue=secondsToMs,
         )
         self.customColumns.append(cc)
         # ------------------------------- #
 
         # Slowest time
-        def cSlowtimeOnData(c, n, t):
-            tm = mw.col.db.scalar(
-                "select time/1000.0 from revlog where cid = ? "
-                "order by time desc limit 1", c.id)
+        def cSlowtimeOnData(stats):
+            tm = stats.slowTime
             if tm:
-                return mw.col.format_timespan(tm)
+                return mw.col.format_timespan(tm/1000.0)
             return None
 
-        srt = ("(select time/1000.0 from revlog where cid = c.id "
-               "order by time DESC limit 1) asc nulls last")
-
         cc = advBrowser.newCustomColumn(
             type='cslowtime',
             name='Slowest Review',
-            onData=cSlowtimeOnData,
-            onSort=getOnSort(srt)
+            onData=None,
+            onDataBatch=revlogBatch(cSlowtimeOnData),
+            deferred=True,
+            cache=("revlog",),
+            sortTableFunction=refreshReviewStats,
+            onSort=revlogSort("slowTime"),
+            searchValue=secondsToMs,
         )
         self.customColumns.append(cc)
         # ------------------------------- #
 
-        # Overdue interval
-        def cOverdueIvl(c, n, t):
-            val = self.valueForOverdue(c.queue, c.type, c.due, c.odue)
-            if val:
-                return mw.col.format_timespan(val * 24 * 60 * 60, context=FormatTimeSpanContext.INTERVALS)
-
-        srt = (f"""
-        (select
-          (case
-             when queue = {QUEUE_TYPE_LRN} then null
-             when queue = {QUEUE_TYPE_NEW} then null
-             when type = {CARD_TYPE_NEW} then null
-             when {mw.col.sched.today} - due <= 0 then null
-             when odid then ({mw.col.sched.today} - odue)
-             when (queue = {QUEUE_TYPE_REV} or queue = {QUEUE_TYPE_DAY_LEARN_RELEARN} or (type = {CARD_TYPE_REV} and queue < 0)) then ({mw.col.sched.today} - due)
-           end
-          )
-        from cards where id = c.id) asc nulls last""")
+        # Cards whose due date is a day number, and how far past it
+        # they are.
+        reviewQueue = (f"(c.queue in ({QUEUE_TYPE_REV}, {QUEUE_TYPE_DAY_LEARN_RELEARN}) "
+                       f"or (c.type = {CARD_TYPE_REV} and c.queue < 0))")
 
-        cc = advBrowser.newCustomColumn(
+        def daysPastDue():
+            return f"({mw.col.sched.today} - (case when c.odid then c.odue else c.due end))"
+
+        # Overdue interval
+        cc = advBrowser.newSqlColumn(
             type='coverdueivl',
             name="Overdue Interval",
-            onData=cOverdueIvl,
-            onSort=getOnSort(srt)
+            expression=lambda: (
+                f"(case when {reviewQueue} then nullif(max("
+                f"{daysPastDue()}, 0), 0) end)"),
+            format=lambda days: mw.col.format_timespan(
+                days * 24 * 60 * 60, context=FormatTimeSpanContext.INTERVALS),
+            cache=("day",),
         )
         self.customColumns.append(cc)
         # ------------------------------- #
 
         # Percentage of scheduled interval
-        def cPercentageSchedIvl(c, n, t):
-            val = self.reviewCardPercentageDue(c.odid, c.odue, c.queue, c.type, c.due, c.ivl)
-            if val:
-                return "{0:.2f}".format(val) + " %"
-
-        srt = (f"""
-        (select
-          (case
-             when odue and (type = {CARD_TYPE_REV} or type = {CARD_TYPE_RELEARNING}) then (
-                (({mw.col.sched.today} - odue + ivl) * 1.0) / (ivl * 1.0)
-                )
-             when (type = {CARD_TYPE_REV} or type = {CARD_TYPE_RELEARNING}) then (
-                (({mw.col.sched.today} - due + ivl) * 1.0) / (ivl * 1.0)
-                )
-             else null
-           end
-          )
-        from cards where id = c.id) asc nulls last""")
-
-        cc = advBrowser.newCustomColumn(
+        cc = advBrowser.newSqlColumn(
             type='cpercentageschedivl',
             name="% of Ivl",
-            onData=cPercentageSchedIvl,
-            onSort=getOnSort(srt)
+            expression=lambda: (
+                f"(case when {reviewQueue} then ("
+                f"{daysPastDue()} + c.ivl) * 100.0 / c.ivl end)"),
+            format="{0:.2f} %".format,
+            cache=("day",),
         )
         self.customColumns.append(cc)
         # ------------------------------- #
 
         # Previous interval
-        def cPrevIvl(c, n, t):
-            ivl = mw.col.db.scalar(
-                "select ivl from revlog where cid = ? "
-                "order by id desc limit 1 offset 1", c.id)
+        def cPrevIvl(stats):
+            ivl = stats.prevIvl
             if ivl is None:
                 return
             elif ivl == 0:
@@ -210,105 +229,95 @@ class AdvancedFields:
             else:
                 return mw.col.format_timespan(-ivl, context=FormatTimeSpanContext.INTERVALS)
 
-        srt = ("(select ivl from revlog where cid = c.id "
-               "order by id desc limit 1 offset 1) asc nulls last")
-
         cc = advBrowser.newCustomColumn(
             type='cprevivl',
             name="Previous Interval",
-            onData=cPrevIvl,
-            onSort=getOnSort(srt)
+            onData=None,
+            onDataBatch=revlogBatch(cPrevIvl),
+            deferred=True,
+            cache=("revlog",),
+            sortTableFunction=refreshReviewStats,
+            onSort=revlogSort("prevIvl"),
         )
         self.customColumns.append(cc)
         # ------------------------------- #
 
         # Total Number of 1/Again (also on new and learning cards)
-        def cAgainCount(c, n, t):
-            val = mw.col.db.scalar(f"select count() from revlog where cid={c.id} and ease=1")
+        def cAgainCount(stats):
+            val = stats.againCount
             if val:
                 return val
 
         cc = advBrowser.newCustomColumn(
             type='cAgainCount',
             name="Again Count",
-            onData=cAgainCount,
-            onSort=lambda: "(select count() from revlog where cid = c.id and ease=1)"
+            onData=None,
+            onDataBatch=revlogBatch(cAgainCount),
+            deferred=True,
+            cache=("revlog",),
+            sortTableFunction=refreshReviewStats,
+            onSort=revlogSort("againCount", default=0),
         )
         self.customColumns.append(cc)
         # ------------------------------- #
 
         # Percent correct
-        def cPctCorrect(c, n, t):
-            if c.reps > 0:
-                return "{:2.0f}%".format(
-                    100 - ((c.lapses / float(c.reps)) * 100))
-            return None
-
-        cc = advBrowser.newCustomColumn(
+        cc = advBrowser.newSqlColumn(
             type='cpct',
             name='Percent Correct',
-            onData=cPctCorrect,
-            onSort=lambda: "cast(c.lapses as real)/c.reps asc nulls last"
+            expression="(100 - c.lapses * 100.0 / c.reps)",
+            format="{:2.0f}%".format,
         )
         self.customColumns.append(cc)
         # ------------------------------- #
 
         # Previous duration
-        def cPrevDur(c, n, t):
-            time = mw.col.db.scalar(
-                "select time/1000.0 from revlog where cid = ? "
-                "order by id desc limit 1", c.id)
+        def cPrevDur(stats):
+            time = stats.lastTime
             if time:
-                return mw.col.format_timespan(time)
+                return mw.col.format_timespan(time/1000.0)
             return None
 
-        srt = ("(select time/1000.0 from revlog where cid = c.id "
-               "order by id desc limit 1) asc nulls last")
-
         cc = advBrowser.newCustomColumn(
             type='cprevdur',
             name="Previous Duration",
-            onData=cPrevDur,
-            onSort=getOnSort(srt)
+            onData=None,
+            onDataBatch=revlogBatch(cPrevDur),
+            deferred=True,
+            cache=("revlog",),
+            sortTableFunction=refreshReviewStats,
+            onSort=revlogSort("lastTime"),
+            searchValue=secondsToMs,
         )
         self.customColumns.append(cc)
         # ------------------------------- #
 
         # Created Time (Note)
-        def cDateTimeCrt(c, n, t):
-            return time.strftime("%Y-%m-%d %H:%M:%S", time.localtime(c.note().id/1000))
-
-        cc = advBrowser.newCustomColumn(
+        cc = advBrowser.newSqlColumn(
             type='ctimecrtn',
             name='Created Time (Note)',
-            onData=cDateTimeCrt,
-            onSort=lambda: "n.id asc nulls last"
+            expression="n.id",
+            format=lambda id: time.strftime("%Y-%m-%d %H:%M:%S", time.localtime(id/1000)),
         )
         self.customColumns.append(cc)
         # ------------------------------- #
 
         # Created Date (Card)
-        def cDateTimeCrt(c, n, t):
-            return time.strftime("%Y-%m-%d", time.localtime(c.id/1000))
-
-        cc = advBrowser.newCustomColumn(
+        cc = advBrowser.newSqlColumn(
             type='cdatecrtc',
             name='Created Date (Card)',
-            onData=cDateTimeCrt,
-            onSort=lambda: "c.id asc nulls last"
+            expression="c.id",
+            format=lambda id: time.strftime("%Y-%m-%d", time.localtime(id/1000)),
         )
         self.customColumns.append(cc)
         # ------------------------------- #
 
         # Created Time (Card)
-        def cDateTimeCrt(c, n, t):
-            return time.strftime("%Y-%m-%d %H:%M:%S", time.localtime(c.id/1000))
-
-        cc = advBrowser.newCustomColumn(
+        cc = advBrowser.newSqlColumn(
             type='ctimecrtc',
             name='Created Time (Card)',
-            onData=cDateTimeCrt,
-            onSort=lambda: "c.id asc nulls last"
+            expression="c.id",
+            format=lambda id: time.strftime("%Y-%m-%d %H:%M:%S", time.localtime(id/1000)),
         )
         self.customColumns.append(cc)
         # ------------------------------- #
@@ -344,27 +353,30 @@ class AdvancedFields:
                 c.flush()
             return True
 
-        def sortTableFunction():
+        def fillDeckNames(table):
             col = advBrowser.mw.col
-            col.db.execute("drop table if exists tmp")
-            col.db.execute("create temp table tmp (k int primary key, v text)")
             for deck in col.decks.all():
                 advBrowser.mw.col.db.execute(
-                    "insert into tmp values (?,?)", deck['id'], deck['name']
+                    f"insert into {table} values (?,?)", deck['id'], deck['name']
                 )
+
+        def sortTableFunction():
+            sortTables.ensure("deckName", "(k int primary key, v text)",
+                              deckSignature(), fillDeckNames)
+
         cc = advBrowser.newCustomColumn(
             type="cdeck",
             name="Current Deck (Filtered)",
             onData=lambda c, n, t: advBrowser.mw.col.decks.name(c.did),
             sortTableFunction=sortTableFunction,
-            onSort=lambda: "(select v from tmp where k = c.did) collate nocase asc",
+            onSort=lambda: f"(select v from {sortTables.tableName('deckName')} where k = c.did) collate nocase asc",
             setData=setData,
         )
         self.customColumns.append(cc)
         # ------------------------------- #
 
         # Flags
-        def setData(c: Card, value: str):
+        def editData(c: Card, n: Note, value: str):
             try:
                 value = int(value)
             except ValueError:
@@ -373,15 +385,16 @@ class AdvancedFields:
                     return False
             if not 0 <= value <= 7:
                 return False
-            set_card_flag(parent=advBrowser.browser, card_ids=[c.id], flag=value).run_in_background()
+            # Card.set_user_flag() without its deprecation warning
+            c.flags = (c.flags & ~0b111) | value
             return True
 
-        cc = advBrowser.newCustomColumn(
+        cc = advBrowser.newSqlColumn(
             type="cflags",
             name="Flag",
-            onData=lambda c, n, t: mw.flags.get_flag(c.flags).label if c.flags else None,
-            onSort=lambda: "(case when c.flags = 0 then null else c.flags end) asc nulls last",
-            setData=setData,
+            expression="nullif(c.flags & 7, 0)",
+            format=lambda flag: mw.flags.get_flag(flag).label,
+            editData=editData,
         )
         self.customColumns.append(cc)
         # ------------------------------- #
@@ -394,38 +407,6 @@ class AdvancedFields:
         for column in self.customColumns:
             group.addItem(column)
 
-    def valueForOverdue(self, queue, type, due, odue):
-        if queue == QUEUE_TYPE_LRN:
-            return
-        elif queue == QUEUE_TYPE_NEW or type == CARD_TYPE_NEW:
-            return
-        else:
-            card_due = odue if odue else due
-            diff = mw.col.sched.today - card_due
-            if diff <= 0:
-                return
-            if queue in (QUEUE_TYPE_REV, QUEUE_TYPE_DAY_LEARN_RELEARN) or (type == CARD_TYPE_REV and queue < 0):
-                return diff
-            else:
-                return
-
-    def reviewCardPercentageDue(self, odid, odue, queue, type, due, ivl):
-        if odid:
-            due = odue
-        if queue == QUEUE_TYPE_LRN:
-            return 0.0
-        elif queue == QUEUE_TYPE_NEW or type == CARD_TYPE_NEW:
-            return 0.0
-        elif queue in (QUEUE_TYPE_REV, QUEUE_TYPE_DAY_LEARN_RELEARN) or (type == CARD_TYPE_REV and queue < 0):
-            try:
-                last_rev = due - ivl
-                elapsed = mw.col.sched.today - last_rev
-                p = elapsed/float(ivl) * 100
-                return p
-            except ZeroDivisionError:
-                return 0.0
-        return 0.0
-
 af = AdvancedFields()
 addHook("advBrowserLoaded", af.onAdvBrowserLoad)
 addHook("advBrowserBuildContext", af.onBuildContextMenu)
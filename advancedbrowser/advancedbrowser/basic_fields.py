@@ -9,11 +9,14 @@
 # be fetched from the original source and that function is never reached.
 
 from anki.cards import Card
+from anki.notes import Note
 from anki.consts import *
 from anki.hooks import addHook
 from aqt.utils import tr
 from aqt.utils import askUser
 
+from .sort_tables import sortTables, deckSignature, notetypeSignature
+
 
 class BasicFields:
 
@@ -26,8 +29,7 @@ class BasicFields:
         # use this to build our part of the context menu.
         self.customColumns = []
 
-        def setData(c: Card, value: str):
-            n = c.note()
+        def editData(c: Card, n: Note, value: str):
             m = n.note_type()
             if m["type"] == MODEL_CLOZE:
                 tmpl = m["tmpls"][0]
@@ -49,14 +51,10 @@ class BasicFields:
                 if right_tmpl is None:
                     return False
                 c.ord = right_tmpl["ord"]
-            c.flush()
             return True
 
-        def sortTableFunction():
+        def fillTemplateNames(table):
             col = advBrowser.mw.col
-            col.db.execute("drop table if exists tmp")
-            col.db.execute("create temporary table tmp (mid int, ord int, v text, primary key (mid, ord)) without rowid;")
-
             for model in col.models.all():
                 templates = model['tmpls']
                 for template in templates:
@@ -67,24 +65,27 @@ class BasicFields:
                         name = template['name']
 
                     advBrowser.mw.col.db.execute(
-                        "insert into tmp values (?,?,?)", model['id'], ord, name
+                        f"insert into {table} values (?,?,?)", model['id'], ord, name
                     )
 
+        def sortTableFunction():
+            sortTables.ensure(
+                "templateName",
+                "(mid int, ord int, v text, primary key (mid, ord)) without rowid",
+                notetypeSignature(), fillTemplateNames)
+
         cc = advBrowser.newCustomColumn(
             type="template",
             name="Card",
             onData=None,
             sortTableFunction=sortTableFunction,
-            onSort=lambda: "(select v from tmp where mid = n.mid and ord = c.ord) collate nocase asc",
-            setData=setData,
+            onSort=lambda: f"(select v from {sortTables.tableName('templateName')} where mid = n.mid and ord = c.ord) collate nocase asc",
+            editData=editData,
         )
         self.customColumns.append(cc)
 
-        def setData(c: Card, value: str):
-            n = c.note()
+        def editData(c: Card, n: Note, value: str):
             n.setTagsFromStr(value)
-            n.flush()
-            advBrowser.editor.loadNote()
             return True
 
         cc = advBrowser.newCustomColumn(
@@ -92,46 +93,51 @@ class BasicFields:
             name="Tags",
             onData=None,
             onSort=lambda: "(case when trim(n.tags) = '' then null else n.tags end) asc nulls last",
-            setData=setData,
+            editData=editData,
         )
         self.customColumns.append(cc)
 
-        def sortTableFunction():
+        def fillNotetypeNames(table):
             col = advBrowser.mw.col
-            col.db.execute("drop table if exists tmp")
-            col.db.execute("create temp table tmp (k int primary key, v text)")
             for model in col.models.all():
                 advBrowser.mw.col.db.execute(
-                    "insert into tmp values (?,?)", model['id'], model['name']
+                    f"insert into {table} values (?,?)", model['id'], model['name']
                 )
 
+        def sortTableFunction():
+            sortTables.ensure("notetypeName", "(k int primary key, v text)",
+                              notetypeSignature(), fillNotetypeNames)
+
         cc = advBrowser.newCustomColumn(
             type="note",
             name="Note",
             onData=None,
             sortTableFunction=sortTableFunction,
-            onSort=lambda: "(select v from tmp where k = n.mid) collate nocase asc",
+            onSort=lambda: f"(select v from {sortTables.tableName('notetypeName')} where k = n.mid) collate nocase asc",
         )
         self.customColumns.append(cc)
 
-        def sortTableFunctionDeckName():
+        def fillDeckNames(table):
             col = advBrowser.mw.col
-            col.db.execute("drop table if exists tmp")
-            col.db.execute("create temp table tmp (k int primary key, v text)")
             for deck in col.decks.all():
                 advBrowser.mw.col.db.execute(
-                    "insert into tmp values (?,?)", deck['id'], deck['name']
+                    f"insert into {table} values (?,?)", deck['id'], deck['name']
                 )
+
+        def sortTableFunctionDeckName():
+            sortTables.ensure("deckName", "(k int primary key, v text)",
+                              deckSignature(), fillDeckNames)
+
         cc = advBrowser.newCustomColumn(
             type="deck",
             name="Deck",
             onData=None,
             sortTableFunction=sortTableFunctionDeckName,
-            onSort=lambda: "(select v from tmp where k = c.did) collate nocase asc",
+            onSort=lambda: f"(select v from {sortTables.tableName('deckName')} where k = c.did) collate nocase asc",
         )
         self.customColumns.append(cc)
 
-        def setData(c: Card, value: str):
+        def editData(c: Card, n: Note, value: str):
             value = value.strip()
             if value.endswith("%"):
                 value = value[:-1]
@@ -139,8 +145,7 @@ class BasicFields:
                 f = float(value)
             except ValueError:
                 return False
-            c.factor = f * 10
-            c.flush()
+            c.factor = round(f * 10)
             return True
 
         cc = advBrowser.newCustomColumn(
@@ -148,7 +153,7 @@ class BasicFields:
             name="Ease",
             onData=None,
             onSort=lambda: f"(case when type = {CARD_TYPE_NEW} then null else factor end) asc nulls last",
-            setData=setData,
+            editData=editData,
         )
         self.customColumns.append(cc)
 
@@ -179,7 +184,7 @@ class BasicFields:
             name="Original Deck",
             onData=lambda c, n, t: advBrowser.mw.col.decks.name(c.odid),
             sortTableFunction=sortTableFunctionDeckName,
-            onSort=lambda: "(select v from tmp where k = c.odid) collate nocase asc nulls last",
+            onSort=lambda: f"(select v from {sortTables.tableName('deckName')} where k = c.odid) collate nocase asc nulls last",
             setData=setData,
         )
         self.customColumns.append(cc)
@@ -0,0 +1,174 @@
+# -*- coding: utf-8 -*-
+# See github page to report issues or to contribute:
+# https://github.com/hssm/advanced-browser
+
+# Editing many cells at once: typing a value for a column of all selected
+# rows, or pasting a block of values copied from a spreadsheet. Only
+# columns with an editData function can be edited this way (see
+# CustomColumn).
+#
+# Every value is validated and applied to the cards and notes in memory
+# first. If all of them are valid, the changed cards and notes are saved
+# by a single operation, which is undone as a whole and makes the browser
+# and editor reload only once.
+
+from aqt.operations import CollectionOp
+from aqt.qt import *
+from aqt.utils import getText, showWarning, tooltip
+
+from . import config
+
+# Number of invalid values listed when refusing an edit
+MAX_ERRORS_SHOWN = 20
+
+
+def editCells(advBrowser, edits, parent):
+    """Apply edits = [(row, column type, value)] and save them as one
+    undoable operation, or save nothing if any value is invalid. Return
+    whether the values were accepted."""
+    model = advBrowser.table._model
+    # {id -> (object, its state before editing)}
+    cards = {}
+    notes = {}
+    errors = []
+    for row, type, value in edits:
+        column = advBrowser.customTypes[type]
+        card = model.get_card(model.index(row, 0))
+        if card is None:
+            continue
+        card = cards.setdefault(card.id, (card, card._to_backend_card()))[0]
+        if card.nid not in notes:
+            note = card.note()
+            notes[note.id] = (note, note._to_backend_note())
+        note = notes[card.nid][0]
+        result = column.editData(card, note, value)
+        if result is not True:
+            errors.append((row, column.name, value, result or None))
+
+    if errors:
+        if len(edits) == 1:
+            # Like a single edit with setData, only explained if the
+            # column says why.
+            if errors[0][3]:
+                showWarning(errors[0][3], parent=parent)
+            return False
+        lines = [f"Row {row + 1}, {name}: {message or repr(value)}"
+                 for row, name, value, message in errors[:MAX_ERRORS_SHOWN]]
+        if len(errors) > MAX_ERRORS_SHOWN:
+            lines.append(f"... and {len(errors) - MAX_ERRORS_SHOWN} more")
+        showWarning("Nothing was changed, as these values aren't valid:\n\n"
+                    + "\n".join(lines), parent=parent)
+        return False
+
+    changedCards = [card for card, old in cards.values()
+                    if card._to_backend_card() != old]
+    changedNotes = [note for note, old in notes.values()
+                    if note._to_backend_note() != old]
+    if not changedCards and not changedNotes:
+        return True
+
+    def op(col):
+        pos = col.add_custom_undo_entry(
+            "Edit Cell" if len(edits) == 1 else "Edit Cells")
+        if changedCards:
+            col.update_cards(changedCards)
+        if changedNotes:
+            col.update_notes(changedNotes)
+        return col.merge_undo_entries(pos)
+
+    CollectionOp(parent, op).run_in_background()
+    return True
+
+
+def selectedRows(table):
+    return sorted(index.row() for index in table._selected())
+
+
+def columnTypes(advBrowser, first, count):
+    """Return the types of count columns from section first, or None
+    with a warning if any of them can't be edited in bulk."""
+    model = advBrowser.table._model
+    if first + count > model.len_columns():
+        showWarning("There are more columns to paste than columns shown "
+                    "from the current one.", parent=advBrowser.browser)
+        return None
+    types = []
+    for section in range(first, first + count):
+        column = model.column_at_section(section)
+        custom = advBrowser.customTypes.get(column.key)
+        if custom is None or custom.editData is None:
+            showWarning(f"The column \"{advBrowser.table._state.column_label(column)}\" "
+                        "can't be edited for many cells at once.",
+                        parent=advBrowser.browser)
+            return None
+        types.append(column.key)
+    return types
+
+
+def editSelected(advBrowser):
+    """Ask for a value and apply it to the current column of every
+    selected row."""
+    table = advBrowser.table
+    current = table._current()
+    rows = selectedRows(table)
+    if not current.isValid() or not rows:
+        return
+    types = columnTypes(advBrowser, current.column(), 1)
+    if types is None:
+        return
+    value, ok = getText(
+        f"Value for the {len(rows)} selected rows:",
+        parent=advBrowser.browser,
+        default=table._model.get_cell(current).text,
+        title="Edit Cells")
+    if ok:
+        editCells(advBrowser, [(row, types[0], value) for row in rows],
+                  advBrowser.browser)
+
+
+def paste(advBrowser):
+    """Paste a block of tab-separated lines from the clipboard, starting
+    at the current cell. With several rows selected, the lines go to
+    the selected rows in order (a single line goes to all of them).
+    Otherwise they go to the rows from the current one down."""
+    table = advBrowser.table
+    current = table._current()
+    text = QApplication.clipboard().text()
+    if not current.isValid() or not text:
+        return
+    block = [line.split("\t") for line in text.splitlines()]
+    width = max(len(line) for line in block)
+
+    rows = selectedRows(table)
+    if len(rows) > 1:
+        if len(block) == 1:
+            block = block * len(rows)
+        elif len(block) != len(rows):
+            showWarning(f"The clipboard has {len(block)} lines, but "
+                        f"{len(rows)} rows are selected.", parent=advBrowser.browser)
+            return
+    else:
+        rows = list(range(current.row(), current.row() + len(block)))
+        if rows[-1] >= table._model.len_rows():
+            showWarning("There are more lines to paste than rows below the "
+                        "current one.", parent=advBrowser.browser)
+            return
+
+    types = columnTypes(advBrowser, current.column(), width)
+    if types is None:
+        return
+    edits = [(row, type, value)
+             for row, line in zip(rows, block)
+             for type, value in zip(types, line)]
+    if editCells(advBrowser, edits, advBrowser.browser):
+        tooltip(f"Pasted {len(edits)} cells.", parent=advBrowser.browser)
+
+
+def onContextMenu(advBrowser, browser, menu):
+    if config.getSelectable() != "Editable" or browser is not advBrowser.browser:
+        return
+    menu.addSeparator()
+    menu.addAction("Edit Cells of Selected Rows...").triggered.connect(
+        lambda: editSelected(advBrowser))
+    menu.addAction("Paste into Cells").triggered.connect(
+        lambda: paste(advBrowser))
@@ -0,0 +1,97 @@
+# -*- coding: utf-8 -*-
+# See github page to report issues or to contribute:
+# https://github.com/hssm/advanced-browser
+
+# The rendered values of cells of columns that opt in (see the cache
+# parameter of CustomColumn), kept across searches so that showing rows
+# again doesn't run their onData again.
+#
+# A value is stored under the column, the row and the modification times
+# of its card and note, plus the scheduler's day and the highest revlog
+# id for columns depending on them. Editing a card or note, the day
+# rolling over or a new review simply make the old entries unreachable;
+# they are evicted once the cache is full, least recently used first.
+# The cache is bounded by an estimate of the memory its entries take,
+# from the length of their text.
+# Modification times are in seconds, so rows modified in the last few
+# seconds are not cached.
+
+from collections import OrderedDict
+
+# Returned by get() for a cell that isn't cached, as None is a value
+MISSING = object()
+
+# Rows modified less than this many seconds ago are not cached
+RECENT = 2
+
+# Estimated bytes taken by an entry besides the characters of its value:
+# the key and its tuple, the value object and the slot in the dict
+ENTRY_SIZE = 200
+
+MB = 1024 * 1024
+
+
+def entrySize(value):
+    """Return the estimated bytes taken by an entry of a value."""
+    if isinstance(value, str):
+        return ENTRY_SIZE + len(value)
+    return ENTRY_SIZE
+
+
+class CellCache:
+
+    def __init__(self, size=0):
+        # Maximum estimated bytes taken by the entries, 0 disables the
+        # cache.
+        self.size = size
+        # {key -> value} from the least to the most recently used
+        self.values = OrderedDict()
+        # Estimated bytes taken by the entries
+        self.used = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def resize(self, size):
+        self.size = size
+        self._evict()
+
+    def clear(self):
+        self.values.clear()
+        self.used = 0
+
+    def get(self, key):
+        value = self.values.get(key, MISSING)
+        if value is MISSING:
+            self.misses += 1
+        else:
+            self.hits += 1
+            self.values.move_to_end(key)
+        return value
+
+    def put(self, key, value):
+        old = self.values.get(key, MISSING)
+        if old is not MISSING:
+            self.used -= entrySize(old)
+        self.values[key] = value
+        self.values.move_to_end(key)
+        self.used += entrySize(value)
+        self._evict()
+
+    def _evict(self):
+        while self.used > self.size:
+            _, value = self.values.popitem(last=False)
+            self.used -= entrySize(value)
+            self.evictions += 1
+
+    def report(self):
+        """Return a line summarizing the use of the cache."""
+        lookups = self.hits + self.misses
+        rate = f"{self.hits * 100 / lookups:.0f}%" if lookups else "-"
+        return (f"Cell cache: {len(self.values)} values, about "
+                f"{self.used / MB:.1f} of {self.size / MB:g} MB, "
+                f"{self.hits} hits, {self.misses} misses ({rate} hit rate), "
+                f"{self.evictions} evictions")
+
+
+cellCache = CellCache()
@@ -2,6 +2,31 @@
 # See github page to report issues or to contribute:
 # https://github.com/hssm/advanced-browser
 
+import re
+from functools import cached_property
+
+from anki.utils import ids2str
+from aqt import mw
+
+# The ordering part at the end of an ORDER BY term
+reOrdering = re.compile(
+    r"\s+(collate\s+\w+\s+)?(asc|desc)(\s+nulls\s+(first|last))?\s*$",
+    re.IGNORECASE)
+
+
+def sortExpression(order):
+    """Return the expression an ORDER BY term sorts by."""
+    return reOrdering.sub("", order.strip())
+
+
+def sortCollation(order):
+    """Return the collation an ORDER BY term sorts with, or None for the
+    default one."""
+    match = reOrdering.search(order.strip())
+    if match and match.group(1):
+        return match.group(1).split()[1]
+    return None
+
 
 class Column:
     """A basic column. Used to represent built-in columns in some
@@ -18,7 +43,9 @@ class CustomColumn(Column):
     """A custom browser column."""
 
     def __init__(self, type, name, onData, onSort=None,
-                 sortTableFunction=False, setData=None):
+                 sortTableFunction=False, setData=None, onDataBatch=None,
+                 dependencies=None, editData=None, deferred=False,
+                 cache=None, searchValue=None):
         """type = Internally used key to identify the column.
 
         name = Name of column, visible to the user.
@@ -47,19 +74,242 @@ class CustomColumn(Column):
             # Sort by first review date
             return "(select min(id) from revlog where cid = c.id)"
 
+        onDataBatch = Optional function that returns the values of many
+        rows at once. When given, it is used instead of onData. The
+        function must be defined with three parameters: a list of ids,
+        whether the browser is in notes mode, and type. The ids are card
+        ids in cards mode and note ids in notes mode. It must return a
+        dictionary of {id -> value}; missing ids are shown empty. It is
+        called once for each block of rows the browser displays, so a
+        whole screen can be fetched with one query.
+        E.g.:
+        def myColumnOnDataBatch(ids, isNotesMode, type):
+            if isNotesMode:
+                return {}
+            return dict(mw.col.db.all(
+                "select cid, min(id) from revlog where cid in %s "
+                "group by cid" % ids2str(ids)))
+
+        deferred = When True, onDataBatch is too slow to be called while
+        the browser paints its rows. It is called as a background task
+        on Anki's collection thread instead, with mw.col.db as an extra
+        first parameter, and the cells show a placeholder until their
+        values are ready. onDataBatch must not touch the UI.
+        E.g.:
+        def myColumnOnDataBatch(db, ids, isNotesMode, type):
+            return dict(db.execute(
+                "select cid, count() from revlog where cid in %s "
+                "group by cid" % ids2str(ids)))
+
+        newCustomColumn(..., onData=None,
+                        onDataBatch=myColumnOnDataBatch, deferred=True)
+
+        dependencies = Optional tuple of the objects onData uses, out of
+        "card", "note", "noteType" and "deck". When given, onData is
+        called with a RowContext and type instead of card, note and
+        type. The RowContext loads each object the first time a column
+        of the row asks for it, so a row whose columns only need ids
+        never builds a Card or Note.
+        E.g.:
+        def myColumnOnData(ctx, type):
+            return ctx.noteType['name']
+
+        newCustomColumn(..., onData=myColumnOnData,
+                        dependencies=("noteType",))
+
+        cache = Optional tuple of what the value of a cell depends on,
+        besides the card and note of its row, out of "day" (the
+        scheduler's day) and "revlog" (the review log). When given, the
+        values of the column are kept in a cache of rendered cells and
+        reused until the card or note is modified (or the day changes,
+        or a review is added, if listed). Meant for columns that are
+        slow to compute, e.g. formatting field contents. Leave it out if
+        the value depends on anything else, such as deck names.
+        E.g.:
+        newCustomColumn(..., onData=myColumnOnData, cache=("day",))
+
+        searchValue = Optional function that turns a value typed in an
+        adv: search (see column_search.py), already made a number if it
+        looks like one, into the value onSort's expression has for it.
+        Needed when the column sorts by a normalized key rather than by
+        its values.
+        E.g.:
+        newCustomColumn(..., onSort=lambda: "lower(n.sfld)",
+                        searchValue=lambda value: f"{value}".lower())
+
+        editData = Optional function that applies a value typed or
+        pasted into a cell to the card and note of its row, without
+        saving them. The function must be defined with three
+        parameters: card, note, and value. It returns True if the value
+        was applied, or False (or a message explaining why) if the value
+        isn't valid. The add-on saves all cards and notes changed by an
+        edit as one operation that can be undone, which lets columns
+        with editData be edited for many rows at once. When given,
+        setData is not used.
+        E.g.:
+        def myColumnEditData(card, note, value):
+            if not value.isdigit():
+                return False
+            card.due = int(value)
+            return True
 
         """
         self.type = type
         self.name = name
         self.onData = onData
+        self.onDataBatch = onDataBatch
+        self.deferred = deferred
+        self.cache = cache
+        self.dependencies = dependencies
         self.onSort = onSort if onSort else lambda: None
         self.sortTableFunction = sortTableFunction
         self._setData = setData
+        self.editData = editData
+        self.searchValue = searchValue
 
     def setData(self, *args, **kwargs):
         if self._setData is None:
             return False
         return self._setData(*args, **kwargs)
 
+    def sortClause(self, backwards=False):
+        """Return the ORDER BY clause of the column, in descending order
+        if backwards, or None if it can't be sorted."""
+        order = self.onSort()
+        if order and backwards:
+            order = order.replace(" asc", " desc")
+        return order
+
+    def valueExpression(self):
+        """Return the SQL expression over the cards c and notes n that the
+        column is sorted by, or None if it can't be sorted."""
+        order = self.onSort()
+        return sortExpression(order) if order else None
+
+    def predicate(self, operator):
+        """Return an SQL condition comparing the value of the column, as
+        sorted, to a parameter with one of = != < > <= >=."""
+        order = self.onSort()
+        expression = sortExpression(order)
+        if collation := sortCollation(order):
+            expression = f"({expression}) collate {collation}"
+        return f"({expression}) {operator} ?"
+
     def __hash__(self):
         return hash(self.name)
+
+
+class SqlColumn(CustomColumn):
+    """A custom column whose value is one SQL expression over the cards c
+    and notes n, like c.reps or n.id. Its cells, sorting, statistics and
+    adv: searches are all derived from that expression, so they can't
+    disagree. The cells of a whole page are fetched with one query, from
+    the first card of each note in notes mode."""
+
+    def __init__(self, type, name, expression, format=None, collation=None,
+                 sortTableFunction=False, deferred=False, cache=None,
+                 setData=None, editData=None, searchValue=None):
+        """expression = SQL expression of the value of a card, or a
+        function returning it when it changes over time (e.g., it
+        includes the scheduler's day).
+
+        format = Optional function that returns the text of a cell from
+        the value of the expression, which is never None. Values are
+        shown as they are without it.
+
+        collation = Optional collation the expression is sorted and
+        compared with, e.g. "nocase".
+
+        The other parameters are those of CustomColumn.
+        E.g.:
+        newSqlColumn(type="creps", name="Reviews", expression="c.reps",
+                     format=lambda reps: f"{reps} reviews")
+
+        """
+        super().__init__(
+            type, name, None, onSort=lambda: self.sortClause(),
+            sortTableFunction=sortTableFunction, setData=setData,
+            onDataBatch=self.fetchDeferred if deferred else self.fetch,
+            editData=editData, deferred=deferred, cache=cache,
+            searchValue=searchValue)
+        self.expression = expression if callable(expression) else lambda: expression
+        self.format = format
+        self.collation = collation
+
+    def batchQuery(self, ids, isNotesMode):
+        expression = self.expression()
+        if isNotesMode:
+            # SQLite takes the other columns from the row of min()
+            return (f"select n.id, {expression}, min(c.ord) from cards c, notes n "
+                    f"where c.nid = n.id and n.id in {ids2str(ids)} group by n.id")
+        return (f"select c.id, {expression} from cards c, notes n "
+                f"where c.nid = n.id and c.id in {ids2str(ids)}")
+
+    def formatRows(self, rows):
+        format = self.format
+        return {id: value if value is None or format is None else format(value)
+                for id, value, *_ in rows}
+
+    def fetch(self, ids, isNotesMode, type):
+        return self.formatRows(mw.col.db.all(self.batchQuery(ids, isNotesMode)))
+
+    def fetchDeferred(self, db, ids, isNotesMode, type):
+        return self.formatRows(db.execute(self.batchQuery(ids, isNotesMode)))
+
+    def valueExpression(self):
+        return self.expression()
+
+    def sortClause(self, backwards=False):
+        expression = self.expression()
+        if self.collation:
+            expression = f"({expression}) collate {self.collation}"
+        return f"{expression} {'desc' if backwards else 'asc'} nulls last"
+
+    def predicate(self, operator):
+        expression = self.expression()
+        if self.collation:
+            expression = f"({expression}) collate {self.collation}"
+        return f"({expression}) {operator} ?"
+
+
+class RowContext:
+    """The objects behind a row of the browser. Each of them is loaded
+    the first time it is accessed and then shared by every column of
+    the row."""
+
+    def __init__(self, state, item, isNotesMode):
+        self._state = state
+        # Card id in cards mode, note id in notes mode.
+        self.item = item
+        self.isNotesMode = isNotesMode
+
+    @cached_property
+    def card(self):
+        """The card of the row, or the first card of the note in notes
+        mode."""
+        if self.isNotesMode:
+            # Same as NoteState.get_card, but reuses the note.
+            return self.note.cards()[0]
+        return self._state.get_card(self.item)
+
+    @cached_property
+    def note(self):
+        if self.isNotesMode:
+            return self._state.get_note(self.item)
+        return self.card.note()
+
+    @cached_property
+    def noteType(self):
+        return self.note.note_type()
+
+    @cached_property
+    def deck(self):
+        return self.card.col.decks.get(self.card.did)
+
+    @property
+    def cardId(self):
+        return self.card.id if self.isNotesMode else self.item
+
+    @property
+    def noteId(self):
+        return self.item if self.isNotesMode else self.card.nid
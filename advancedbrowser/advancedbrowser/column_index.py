@@ -0,0 +1,91 @@
+# -*- coding: utf-8 -*-
+# See github page to report issues or to contribute:
+# https://github.com/hssm/advanced-browser
+
+# An index of every column of the header context menu by its name and the
+# names of the menus it is in (e.g., the notetypes of a field), for the
+# column picker to search as the user types.
+#
+# Names are split into words, which are kept in one sorted list. A word
+# typed by the user matches the columns having a word that starts with
+# it, found by bisecting that list, so a search doesn't go through every
+# column, of which there can be thousands with many notetypes.
+
+import re
+from bisect import bisect_left
+from collections import namedtuple
+
+from .contextmenu import ContextMenu
+
+# A column of the menu. groups are the paths of the menus it is found in,
+# e.g. ("Fields > Basic", "Fields > Cloze").
+ColumnEntry = namedtuple("ColumnEntry", ["type", "name", "groups", "key"])
+
+reWord = re.compile(r"\w+")
+
+
+def groupName(menu):
+    # Group names are decorated like " - Fields -"
+    return menu.name.strip(" -")
+
+
+class ColumnIndex:
+
+    def __init__(self, contextMenu):
+        """Index the columns of a ContextMenu tree. This fills any
+        sub-menus that were left to be filled when opened."""
+        # {type -> (name, [group path])}
+        found = {}
+
+        def walk(menu, path):
+            for item in menu.items():
+                if isinstance(item, ContextMenu):
+                    walk(item, path + (groupName(item),))
+                else:
+                    name, groups = found.setdefault(item.type, (item.name, []))
+                    if path:
+                        groups.append(" > ".join(path))
+        walk(contextMenu, ())
+
+        self.entries = sorted(
+            (ColumnEntry(type, name, tuple(groups), name.casefold())
+             for type, (name, groups) in found.items()),
+            key=lambda entry: entry.key)
+
+        # Sorted (word, position in self.entries) of the words of the
+        # name and groups of every column
+        words = set()
+        for position, entry in enumerate(self.entries):
+            for text in (entry.key,) + entry.groups:
+                for word in reWord.findall(text.casefold()):
+                    words.add((word, position))
+        self.words = sorted(words)
+
+    def matching(self, word):
+        """Return the positions of the entries having a word in their
+        name or groups that starts with word."""
+        positions = set()
+        index = bisect_left(self.words, (word,))
+        while index < len(self.words) and self.words[index][0].startswith(word):
+            positions.add(self.words[index][1])
+            index += 1
+        return positions
+
+    def search(self, query):
+        """Return the entries matching every word of the query, as the
+        start of a word of the column name or of a group name. Columns
+        whose name starts with the query come first, each part sorted by
+        name."""
+        words = reWord.findall(query.casefold())
+        if not words:
+            return list(self.entries)
+        positions = self.matching(words[0])
+        for word in words[1:]:
+            positions &= self.matching(word)
+        prefix = " ".join(query.casefold().split())
+        first = []
+        rest = []
+        for position in sorted(positions):
+            entry = self.entries[position]
+            (first if entry.key.startswith(prefix) else rest).append(entry)
+        return first + rest
@@ -0,0 +1,137 @@
+# -*- coding: utf-8 -*-
+# See github page to report issues or to contribute:
+# https://github.com/hssm/advanced-browser
+
+# Searching by the value of a custom column, e.g. adv:cAgainCount>=5 or
+# "adv:_field_Front=some text".
+#
+# Before the browser runs a search, every adv: term is replaced by the
+# list of cards (or notes in notes mode) it matches, so that it combines
+# with the rest of the search like any other term. The matches are found
+# by SQLite over the whole collection, comparing the expression of the
+# column's ORDER BY clause, i.e. the value it is sorted by. Columns that
+# sort by other units than they show, like review times in milliseconds,
+# or by a normalized key, like fields, turn the value searched for into
+# those (see the searchValue parameter of CustomColumn). Columns needing
+# a sort table have it prepared first, in the background if it takes a
+# while, like for sorting (see sort_builder).
+
+import re
+
+# An adv: term, quoted as a whole, with its value quoted, or unquoted
+reTerm = re.compile(
+    r'(?<![^\s(-])(?:"adv:([^"]*)"|adv:((?:[^\s()"]*"[^"]*")|[^\s()"]+))',
+    re.IGNORECASE)
+reCondition = re.compile(r"^(.+?)(<=|>=|!=|=|<|>)(.*)$", re.DOTALL)
+
+
+class ColumnSearchError(Exception):
+    pass
+
+
+def parseValue(text):
+    """Return the number a value stands for, or the text without its
+    quotes."""
+    if text.startswith('"') and text.endswith('"') and len(text) >= 2:
+        return text[1:-1]
+    try:
+        return int(text)
+    except ValueError:
+        pass
+    try:
+        return float(text)
+    except ValueError:
+        return text
+
+
+class ColumnSearch:
+
+    def __init__(self, advBrowser):
+        self.advBrowser = advBrowser
+
+    def findColumn(self, key):
+        customTypes = self.advBrowser.customTypes
+        if key in customTypes:
+            return customTypes[key]
+        # Be lenient with the case of the column type or name
+        folded = key.casefold()
+        for cc in customTypes.values():
+            if cc.type.casefold() == folded or cc.name.casefold() == folded:
+                return cc
+        return None
+
+    def parseCondition(self, condition):
+        """Return the column, operator and value of a condition like
+        cAgainCount>=5."""
+        match = reCondition.match(condition)
+        if not match:
+            raise ColumnSearchError(
+                f"adv:{condition} should be like adv:column>value, with one of "
+                "the operators = != < > <= >=.")
+        key, operator, value = match.groups()
+        cc = self.findColumn(key.strip())
+        if cc is None:
+            raise ColumnSearchError(f"adv:{condition}: no column {key!r}.")
+        if not cc.onSort():
+            raise ColumnSearchError(
+                f"adv:{condition}: the column {cc.name} can't be searched, "
+                "as it can't be sorted.")
+        value = parseValue(value.strip())
+        if cc.searchValue:
+            value = cc.searchValue(value)
+        return cc, operator, value
+
+    def matchingIds(self, cc, operator, value, isNotesMode):
+        """Return the ids of the cards, or notes in notes mode, whose
+        value of a column compares to a value with an operator. The sort
+        table of the column, if any, must be ready."""
+        item = "distinct n.id" if isNotesMode else "c.id"
+        return self.advBrowser.mw.col.db.list(
+            f"select {item} from cards c, notes n where c.nid = n.id "
+            f"and {cc.predicate(operator)}", value)
+
+    def applyTerms(self, ctx):
+        """Replace the adv: terms of a search by the ids they match.
+
+        The sort tables of their columns are prepared like for sorting.
+        If one takes a while, the search is left matching nothing and
+        False is returned; it is run again once the table is ready.
+        Raise ColumnSearchError if a term is invalid or a table can't be
+        built."""
+        if "adv:" not in ctx.search.lower():
+            return True
+        isNotesMode = self.advBrowser.table._state.is_notes_mode()
+
+        # {condition -> (column, operator, value)}
+        conditions = {}
+        for match in reTerm.finditer(ctx.search):
+            condition = match.group(1)
+            if condition is None:
+                condition = match.group(2)
+                # adv:"column=value"
+                if condition.startswith('"') and condition.endswith('"'):
+                    condition = condition[1:-1]
+            conditions[match.group(0)] = self.parseCondition(condition)
+
+        builder = self.advBrowser.sortTableBuilder
+        prepared = set()
+        for cc, _, _ in conditions.values():
+            if cc.sortTableFunction and cc.type not in prepared:
+                try:
+                    ready = builder.prepare(cc, f"Preparing to search by {cc.name}...")
+                except Exception as error:
+                    raise ColumnSearchError(
+                        f"The column {cc.name} can't be searched: {error}") from error
+                if not ready:
+                    ctx.search = "nid:0" if isNotesMode else "cid:0"
+                    return False
+                prepared.add(cc.type)
+
+        def replace(match):
+            ids = self.matchingIds(*conditions[match.group(0)], isNotesMode)
+            # A term matching nothing has to stay a valid search
+            ids = ",".join(str(id) for id in ids) or "0"
+            return f"nid:{ids}" if isNotesMode else f"cid:{ids}"
+
+        ctx.search = reTerm.sub(replace, ctx.search)
+        return True
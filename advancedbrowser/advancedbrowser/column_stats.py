@@ -0,0 +1,152 @@
+# -*- coding: utf-8 -*-
+# See github page to report issues or to contribute:
+# https://github.com/hssm/advanced-browser
+
+# Statistics of a column over every row of the current search: how many
+# rows have a value, and the sum, mean, extremes and a histogram of the
+# numeric ones.
+#
+# The values are not those shown in the cells, which would need onData
+# for every row, but those the column is sorted by: the expression of
+# its ORDER BY clause, evaluated by SQLite for all rows in one statement.
+# For some columns they are in other units than the cells (e.g.,
+# milliseconds, or ease in permille). Only SELECT statements are run, as
+# any other statement would discard the undo history and study queues.
+
+import html
+import json
+from collections import namedtuple
+
+from aqt.operations import QueryOp
+from aqt.utils import showText
+
+# Number of bars of a histogram, unless each integer value gets its own
+MAX_BUCKETS = 10
+# Integer values get a bar each if there are at most this many
+MAX_INTEGER_BUCKETS = 20
+BAR_WIDTH = 40
+
+ColumnStats = namedtuple("ColumnStats", [
+    "rows", "values", "numbers", "sum", "mean", "min", "max",
+    "textMin", "textMax", "histogram"])
+
+def computeStats(col, expression, ids, isNotesMode):
+    """Return the ColumnStats of an expression over the cards c and notes
+    n of the given ids: card ids, or note ids in notes mode."""
+    if len(ids) == (col.note_count() if isNotesMode else col.card_count()):
+        # The whole collection, which SQLite can read without looking up
+        # every id.
+        where = ""
+        args = []
+    else:
+        # The ids are passed as a JSON array, which SQLite reads faster
+        # than a literal list.
+        where = f"and {'n' if isNotesMode else 'c'}.id in (select value from json_each(?))"
+        args = [json.dumps(ids)]
+    select = f"select {expression} as v from cards c, notes n where c.nid = n.id {where}"
+    if isNotesMode:
+        select += " group by n.id"
+    db = col.db
+    # {type -> (count, sum, min, max)} of the values of each SQLite type:
+    # integer, real, text, null or blob
+    byType = {type: rest for type, *rest in db.all(
+        f"select typeof(v), count(), sum(v), min(v), max(v) from ({select}) "
+        "group by 1", *args)}
+    rows = sum(count for count, _, _, _ in byType.values())
+    values = rows - byType.get("null", (0,))[0]
+    numeric = [byType[type] for type in ("integer", "real") if type in byType]
+    numbers = sum(count for count, _, _, _ in numeric)
+    total = mean = lo = hi = None
+    if numbers:
+        total = sum(subtotal for _, subtotal, _, _ in numeric)
+        mean = total / numbers
+        lo = min(low for _, _, low, _ in numeric)
+        hi = max(high for _, _, _, high in numeric)
+    textMin, textMax = byType.get("text", (0, None, None, None))[2:]
+
+    # Numbers sort before text, so the numeric values are those between
+    # the numeric extremes.
+    histogram = []
+    if numbers:
+        if "real" not in byType and hi - lo < MAX_INTEGER_BUCKETS:
+            histogram = [(v, v, n) for v, n in db.all(
+                f"with s as ({select}) select v, count() from s "
+                "where v between ? and ? group by v order by v",
+                *args, lo, hi)]
+        elif hi > lo:
+            width = (hi - lo) / MAX_BUCKETS
+            counts = dict(db.all(f"""
+            with s as ({select})
+            select min(cast((v - ?) / ? as int), ?), count()
+            from s where v between ? and ? group by 1""",
+                *args, lo, width, MAX_BUCKETS - 1, lo, hi))
+            histogram = [(lo + i * width, lo + (i + 1) * width, counts.get(i, 0))
+                         for i in range(MAX_BUCKETS)]
+        else:
+            histogram = [(lo, hi, numbers)]
+    return ColumnStats(rows, values, numbers, total, mean, lo, hi,
+                       textMin, textMax, histogram)
+
+
+def formatNumber(value):
+    if isinstance(value, float) and not value.is_integer():
+        return f"{value:.6g}"
+    return f"{int(value)}"
+
+
+def formatStats(name, expression, stats):
+    """Return a report of the ColumnStats of a column as text."""
+    lines = [
+        f"{name}",
+        f"Sorted by: {expression}",
+        "",
+        f"Rows: {stats.rows}",
+        f"With a value: {stats.values}",
+    ]
+    if stats.numbers:
+        lines += [
+            f"Numeric values: {stats.numbers}",
+            f"Sum: {formatNumber(stats.sum)}",
+            f"Mean: {formatNumber(stats.mean)}",
+            f"Min: {formatNumber(stats.min)}",
+            f"Max: {formatNumber(stats.max)}",
+        ]
+    if stats.textMin is not None:
+        lines += [
+            f"First text value: {stats.textMin}",
+            f"Last text value: {stats.textMax}",
+        ]
+    if stats.histogram:
+        lines += ["", "Histogram of the numeric values:"]
+        largest = max(n for _, _, n in stats.histogram)
+        labels = [formatNumber(lo) if lo == hi
+                  else f"{formatNumber(lo)} - {formatNumber(hi)}"
+                  for lo, hi, _ in stats.histogram]
+        labelWidth = max(len(label) for label in labels)
+        for label, (_, _, n) in zip(labels, stats.histogram):
+            bar = "#" * round(n * BAR_WIDTH / largest) if largest else ""
+            lines.append(f"{label:>{labelWidth}} | {bar} {n}")
+    return "\n".join(lines)
+
+
+def showColumnStats(advBrowser, cc):
+    """Compute the statistics of a custom column over the current search
+    in the background and show them."""
+    ids = list(advBrowser.table._model._items)
+    isNotesMode = advBrowser.table._state.is_notes_mode()
+
+    def op(col):
+        if cc.sortTableFunction:
+            cc.sortTableFunction()
+        expression = cc.valueExpression()
+        return expression, computeStats(col, expression, ids, isNotesMode)
+
+    def success(result):
+        expression, stats = result
+        showText(f"<pre>{html.escape(formatStats(cc.name, expression, stats))}</pre>",
+                 type="html", parent=advBrowser.browser,
+                 title="Advanced Browser column statistics",
+                 minWidth=600, copyBtn=True)
+
+    QueryOp(parent=advBrowser.browser, op=op, success=success).with_progress(
+        f"Computing statistics of {cc.name}...").run_in_background()
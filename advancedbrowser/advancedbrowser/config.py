@@ -33,6 +33,18 @@ def getSelectable():
 def getColumnAlignment():
     return getUserOption().get("Column alignment", "Start")
 
+def getParallelNormalizationThreshold():
+    return getUserOption().get("Parallel field normalization threshold", 1000000)
+
+def getRecordColumnTimings():
+    return getUserOption().get("Record column timings", False)
+
+def getCellCacheSize():
+    return getUserOption().get("Cell cache size (MB)", 10)
+
+def getSlowSearchThreshold():
+    return getUserOption().get("Slow search threshold", 0)
+
 def update(_):
     global userOption
     userOption = None
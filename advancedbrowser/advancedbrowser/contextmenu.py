@@ -4,21 +4,32 @@
 
 
 class ContextMenu:
-    def __init__(self, subGroupName=None):
+    def __init__(self, subGroupName=None, populate=None):
         self._items = []
+        self._sorted = None
         self.name = subGroupName
+        # Optional function that adds the items of the menu when they
+        # are first needed. It is given the menu.
+        self._populate = populate
 
     def addItem(self, item):
         """Add a Column for a menu item or ContextMenu for a sub-menu."""
         self._items.append(item)
+        self._sorted = None
 
-    def newSubMenu(self, name):
-        """Create and add a new sub-menu."""
-        cm = ContextMenu(subGroupName=name)
+    def newSubMenu(self, name, populate=None):
+        """Create and add a new sub-menu. If populate is given, it is
+        called to add the items of the sub-menu only when the sub-menu
+        is opened, which saves building large menus nobody looks at."""
+        cm = ContextMenu(subGroupName=name, populate=populate)
         self.addItem(cm)
         return cm
 
     def items(self):
         """Return a list of all items sorted by name."""
-        self._items = list(sorted(set(self._items), key=lambda x: x.name))
-        return self._items
+        if self._populate is not None:
+            populate, self._populate = self._populate, None
+            populate(self)
+        if self._sorted is None:
+            self._sorted = list(sorted(set(self._items), key=lambda x: x.name))
+        return self._sorted
@@ -2,23 +2,39 @@
 # See github page to report issues or to contribute:
 # https://github.com/hssm/advanced-browser
 
+import html
+import os
 import time
 
 from anki.collection import BrowserColumns
 from anki.browser import BrowserConfig
 from anki.hooks import runHook, wrap
-from anki.utils import pointVersion
+from anki.utils import ids2str, pointVersion
 from aqt import *
 from aqt import gui_hooks
 from aqt.browser import Column as BuiltinColumn, DataModel, SearchContext, CardState, NoteState
-
-from . import config
-from .column import Column, CustomColumn
+from aqt.utils import showText, showWarning, tooltip
+
+from . import bulk_edit, config, export
+from .cell_cache import cellCache, MB, MISSING, RECENT
+from .column import Column, CustomColumn, RowContext, SqlColumn
+from .column_index import ColumnIndex
+from .column_search import ColumnSearch, ColumnSearchError
+from .column_stats import showColumnStats
 from .contextmenu import ContextMenu
+from .deferred import DeferredLoader
+from .notetype_index import notetypeIndex
+from .sort_builder import SortTableBuilder
+from .widgets.column_picker import ColumnPicker
+from .timing import columnTimings, slowSearchLog, SEARCH, SET_DATA
 
 
 CONF_KEY_PREFIX = 'advbrowse_'
 
+# Number of consecutive rows whose data is prefetched together when the
+# table requests a row from a page that hasn't been loaded yet.
+PAGE_SIZE = 100
+
 
 class AdvancedBrowser:
     """Maintains state for the add-on."""
@@ -30,14 +46,33 @@ class AdvancedBrowser:
         # CustomColumn objects maintained by this add-on.
         # {type -> CustomColumn}
         self.customTypes = {}
-        # Model->flds cache, similar to self.cardObjs
-        self.modelFldObjs = {}
+        # The ColumnTimings to record to, or None when not recording.
+        self.timings = None
+        # Custom column the current search is sorted by
+        self.sortColumn = None
+        # Searches taking longer than this many milliseconds are logged,
+        # 0 disables it.
+        self.slowSearchThreshold = 0
+        self.sortTableBuilder = SortTableBuilder(self)
+        # The notetype index generation the cell cache was filled with
+        self._cacheGeneration = None
+        self.deferredLoader = DeferredLoader(self)
+        self.columnSearch = ColumnSearch(self)
+        # The TableExport in progress
+        self.export = None
+        self.resetPages()
+        self.resetContextMenu()
 
     def _load(self, browser):
         self.browser = browser
         self.table = browser.table
         self.editor = browser.editor
         self.col = browser.col
+        self.timings = columnTimings if config.getRecordColumnTimings() else None
+        self.slowSearchThreshold = config.getSlowSearchThreshold()
+        cellCache.resize(int(config.getCellCacheSize() * MB))
+        self.resetPages()
+        self.resetContextMenu()
 
         # Let add-ons add or remove columns now.
         runHook("advBrowserLoaded", self)
@@ -51,11 +86,33 @@ class AdvancedBrowser:
             self.table._view.setEditTriggers(self.table._view.EditTrigger.DoubleClicked)
 
     def newCustomColumn(self, type, name, onData, onSort=None,
-                        setData=None, sortTableFunction=False):
+                        setData=None, sortTableFunction=False,
+                        onDataBatch=None, dependencies=None, editData=None,
+                        deferred=False, cache=None, searchValue=None):
         """Add a CustomColumn to the browser. See CustomColumn for a
         detailed description of the parameters."""
         cc = CustomColumn(type, name, onData, onSort,
-                          sortTableFunction, setData=setData)
+                          sortTableFunction, setData=setData,
+                          onDataBatch=onDataBatch,
+                          dependencies=dependencies,
+                          editData=editData,
+                          deferred=deferred,
+                          cache=cache,
+                          searchValue=searchValue)
+        self.customTypes[cc.type] = cc
+        return cc
+
+    def newSqlColumn(self, type, name, expression, format=None,
+                     collation=None, sortTableFunction=False, deferred=False,
+                     cache=None, setData=None, editData=None,
+                     searchValue=None):
+        """Add a SqlColumn to the browser. See SqlColumn for a detailed
+        description of the parameters."""
+        cc = SqlColumn(type, name, expression, format=format,
+                       collation=collation,
+                       sortTableFunction=sortTableFunction,
+                       deferred=deferred, cache=cache, setData=setData,
+                       editData=editData, searchValue=searchValue)
         self.customTypes[cc.type] = cc
         return cc
 
@@ -81,17 +138,18 @@ class AdvancedBrowser:
             if type in self.table._state.active_columns:
                 self.table._on_column_toggled(False, type)
 
-    def setupColumns(self):
+    def setupColumns(self, types=None):
         """Build a list of candidate columns. We extend the internal
-        self.columns list with our custom types."""
+        self.columns list with our custom types, or only with the given
+        ones."""
         bc = BrowserColumns.SORTING_NORMAL if pointVersion() <= 49 else BrowserColumns.SORTING_ASCENDING
-        for key, column in self.customTypes.items():
-            alignmentConfig = config.getColumnAlignment()
-            if alignmentConfig == "Start":
-                alignment = BrowserColumns.ALIGNMENT_START
-            elif alignmentConfig == "Center":
-                alignment = BrowserColumns.ALIGNMENT_CENTER
-
+        alignmentConfig = config.getColumnAlignment()
+        if alignmentConfig == "Start":
+            alignment = BrowserColumns.ALIGNMENT_START
+        elif alignmentConfig == "Center":
+            alignment = BrowserColumns.ALIGNMENT_CENTER
+        for key in self.customTypes if types is None else types:
+            column = self.customTypes[key]
             self.table._model.columns[key] = BuiltinColumn(
                 key=key,
                 cards_mode_label=column.name,
@@ -103,59 +161,300 @@ class AdvancedBrowser:
             )
 
     def willSearch(self, ctx: SearchContext):
+        self.sortColumn = None
+        if self.timings is not None:
+            self.timings.endSearch()
+        # A new search makes a sort table still being built for the
+        # previous one useless.
+        self.sortTableBuilder.cancel()
+        try:
+            ready = self.columnSearch.applyTerms(ctx)
+        except ColumnSearchError as error:
+            # Anki removes a hook that raises, so leave the search
+            # matching nothing instead.
+            tooltip(f"{error}", parent=self.browser)
+            ctx.search = "nid:0" if self.table._state.is_notes_mode() else "cid:0"
+            ready = False
+        if not ready:
+            # The search matches nothing: an adv: term is invalid, or the
+            # table of its column is being built, and the search is run
+            # again once it is ready.
+            ctx.order = False
         # If the order is a custom column, apply the column's sorting
-        if type(ctx.order) == BuiltinColumn and (cc := self.customTypes.get(ctx.order.key)):
-            order = cc.onSort()
-            if not order:
-                ctx.order = None
-            else:
-                if self.table._state.sort_backwards:
-                    order = order.replace(" asc", " desc")
-                ctx.order = order
+        elif type(ctx.order) == BuiltinColumn and (cc := self.customTypes.get(ctx.order.key)):
+            ctx.order = cc.sortClause(self.table._state.sort_backwards) or False
+
+            # If this column relies on a temporary table for sorting, build it now.
+            # If that takes a while, show the rows unsorted in the meantime.
+            if cc.sortTableFunction and not self.sortTableBuilder.prepare(cc):
+                ctx.order = False
 
-            self.time = time.time()
+            self.sortColumn = cc.type
+        self.time = time.perf_counter()
 
-            # If this column relies on a temporary table for sorting, build it now
-            if cc.sortTableFunction:
-                cc.sortTableFunction()
+    def explainSort(self, order):
+        """Return the EXPLAIN QUERY PLAN rows of a search of the whole
+        collection sorted by the given ORDER BY clause."""
+        return self.mw.col.db.all(
+            "explain query plan select c.id from cards c, notes n "
+            f"where c.nid = n.id order by {order}")
 
     def didSearch(self, ctx: SearchContext):
-        #print("Search took: %dms" % ((time.time() - self.time)*1000))
-        pass
+        elapsed = time.perf_counter() - self.time
+        if self.timings is not None and self.sortColumn is not None:
+            self.timings.add(self.sortColumn, SEARCH, elapsed)
+        if self.slowSearchThreshold and elapsed * 1000 >= self.slowSearchThreshold:
+            self.logSlowSearch(ctx, elapsed)
+
+    def logSlowSearch(self, ctx, elapsed):
+        if isinstance(ctx.order, str):
+            # Sorted by a custom column
+            column = self.sortColumn
+            order = ctx.order
+            try:
+                plan = self.explainSort(order)
+            except Exception as error:
+                plan = [(1, 0, 0, f"{error}")]
+        else:
+            column = ctx.order.key if isinstance(ctx.order, BuiltinColumn) else None
+            order = None
+            plan = None
+        slowSearchLog.add(ctx.search, column, order, elapsed * 1000, plan)
+
+    def showSlowSearches(self):
+        diag, box = showText(
+            f"<pre>{html.escape(slowSearchLog.report())}</pre>", type="html",
+            parent=self.browser, title="Advanced Browser slow searches",
+            minWidth=800, copyBtn=True, run=False)
+
+        def onExport():
+            path, _ = QFileDialog.getSaveFileName(
+                diag, "Export slow searches",
+                os.path.join(QStandardPaths.writableLocation(
+                    QStandardPaths.StandardLocation.DocumentsLocation),
+                    "slow_searches.json"),
+                "JSON (*.json)")
+            if not path:
+                return
+            try:
+                slowSearchLog.export(path)
+            except OSError as error:
+                showWarning(f"{error}", parent=diag)
+                return
+            tooltip(f"Exported {len(slowSearchLog.searches)} searches.", parent=diag)
+
+        def onClear():
+            slowSearchLog.clear()
+            diag.accept()
+            tooltip("Slow searches cleared.", parent=self.browser)
+
+        exportButton = QPushButton("Export...")
+        exportButton.clicked.connect(onExport)
+        box.addButton(exportButton, QDialogButtonBox.ButtonRole.ActionRole)
+        clearButton = QPushButton("Clear")
+        clearButton.clicked.connect(onClear)
+        box.addButton(clearButton, QDialogButtonBox.ButtonRole.ActionRole)
+        diag.exec()
+
+    def timingReport(self):
+        """Return the recorded column timings as text."""
+        names = {key: cc.name for key, cc in self.customTypes.items()}
+        return columnTimings.report(names) + "\n\n" + cellCache.report()
+
+    def showTimings(self):
+        showText(f"<pre>{html.escape(self.timingReport())}</pre>", type="html",
+                 parent=self.browser, title="Advanced Browser column timings",
+                 minWidth=800, copyBtn=True)
+
+    def resetPages(self):
+        """Forget which pages were loaded along with their batch
+        data."""
+        # Values returned by the onDataBatch of custom columns.
+        # {type -> {id -> value}}
+        self.batchData = {}
+        self._loadedPages = set()
+        # The item list and cache cutoff of the table model the pages
+        # were loaded from. The model replaces the former on every
+        # search or reversal and bumps the latter whenever its rows
+        # must be refetched (e.g., after an operation or a column
+        # toggle).
+        self._pageItems = None
+        self._pageCutoff = None
+        # {item -> row} for the current item list, built lazily.
+        self._itemRows = None
+        # For the cell cache, the modification times of the card and
+        # note of loaded rows that weren't modified recently, and the
+        # notetype of all loaded rows.
+        # {item -> (card mod, note mod)}
+        self.rowMods = {}
+        # {item -> mid}
+        self.rowMids = {}
+        # What else cached values depend on: {"day" -> scheduler's day,
+        # "revlog" -> highest revlog id}. Loaded with the first rows.
+        self.cacheContext = None
+
+    def _loadPage(self, item, is_notes_mode, active_columns):
+        """Fetch the batch columns of every row on the same page as item
+        if that page hasn't been loaded yet."""
+        model = self.table._model
+        if (model._items is not self._pageItems
+                or model._stale_cutoff != self._pageCutoff):
+            self.resetPages()
+            self._pageItems = model._items
+            self._pageCutoff = model._stale_cutoff
+            # The rows are reloaded after any change to the notetypes
+            notetypeIndex.refresh()
+            # Field values are cached under the field name
+            if self._cacheGeneration != notetypeIndex.generation:
+                cellCache.clear()
+                self._cacheGeneration = notetypeIndex.generation
+        columns = [cc for key in active_columns if (cc := self.customTypes.get(key))]
+        cached = cellCache.size and any(cc.cache is not None for cc in columns)
+        batched = [cc for cc in columns if cc.onDataBatch is not None]
+        # Numbering the rows of a large search takes a while, and only
+        # columns loaded a page at a time need it.
+        if not cached and not batched:
+            return
+        if self._itemRows is None:
+            self._itemRows = {id: row for row, id in enumerate(model._items)}
+
+        row = self._itemRows.get(item)
+        if row is None:
+            return
+        page = row // PAGE_SIZE
+        if page in self._loadedPages:
+            return
+        self._loadedPages.add(page)
+        items = list(model._items[page*PAGE_SIZE:(page+1)*PAGE_SIZE])
+        if cached:
+            self._loadRowMods(items, is_notes_mode)
+        for custom_type in batched:
+            self._fetchBatch(custom_type, items, is_notes_mode)
+
+    def _loadRowMods(self, items, is_notes_mode):
+        if is_notes_mode:
+            # The first card of a note is shown, but whichever changed
+            # changes the key.
+            sql = ("select n.id, max(c.mod), n.mod, n.mid from notes n "
+                   "join cards c on c.nid = n.id where n.id in %s group by n.id")
+        else:
+            sql = ("select c.id, c.mod, n.mod, n.mid from cards c "
+                   "join notes n on n.id = c.nid where c.id in %s")
+        col = self.mw.col
+        if self.cacheContext is None:
+            self.cacheContext = {
+                "day": col.sched.today,
+                "revlog": col.db.scalar("select max(id) from revlog"),
+            }
+        recent = time.time() - RECENT
+        for id, cardMod, noteMod, mid in col.db.all(sql % ids2str(items)):
+            self.rowMids[id] = mid
+            if cardMod < recent and noteMod < recent:
+                self.rowMods[id] = (cardMod, noteMod)
+
+    def cellCacheKey(self, custom_type, item, is_notes_mode):
+        """Return the key of a cell in the cell cache, or None if it
+        can't be cached."""
+        if custom_type.cache is None or (mods := self.rowMods.get(item)) is None:
+            return None
+        return ((custom_type.type, is_notes_mode, item) + mods
+                + tuple(self.cacheContext[name] for name in custom_type.cache))
+
+    def cellCacheKeys(self, custom_type, items, is_notes_mode):
+        """Return {id -> key in the cell cache} for the given items of a
+        column, leaving out those that can't be cached."""
+        if custom_type.cache is None:
+            return {}
+        keys = {}
+        for item in items:
+            if (key := self.cellCacheKey(custom_type, item, is_notes_mode)) is not None:
+                keys[item] = key
+        return keys
+
+    def cacheCells(self, values, keys):
+        """Store values = {id -> value} of a column in the cell cache,
+        under keys = {id -> key} taken before the values were read, so
+        that they can't be newer than what the values saw."""
+        for item, value in values.items():
+            if (key := keys.get(item)) is not None:
+                cellCache.put(key, value)
+
+    def _fetchBatch(self, custom_type, items, is_notes_mode):
+        """Store the values of a batch column for the given items."""
+        values = self.batchData.setdefault(custom_type.type, {})
+        keys = self.cellCacheKeys(custom_type, items, is_notes_mode)
+        if custom_type.cache is not None:
+            missing = []
+            for item in items:
+                key = keys.get(item)
+                value = cellCache.get(key) if key is not None else MISSING
+                if value is MISSING:
+                    missing.append(item)
+                else:
+                    values[item] = value
+            items = missing
+            if not items:
+                return
+        if custom_type.deferred:
+            self.deferredLoader.fetch(custom_type, items, is_notes_mode, keys)
+            return
+        start = time.perf_counter()
+        try:
+            fetched = custom_type.onDataBatch(items, is_notes_mode, custom_type.type)
+        except Exception as error:
+            fetched = dict.fromkeys(items, f"{error}")
+        else:
+            self.cacheCells(fetched, keys)
+        if self.timings is not None:
+            self.timings.addData(custom_type.type, time.perf_counter() - start)
+        for item in items:
+            values[item] = fetched.get(item)
 
     def _column_data(self, item, is_notes_mode, row, active_columns):
         """Fill in data of custom columns."""
-        c = self.table._state.get_card(item)
-        n = self.table._state.get_note(item)
+        self._loadPage(item, is_notes_mode, active_columns)
+        ctx = RowContext(self.table._state, item, is_notes_mode)
+        timings = self.timings
         for index, key in enumerate(active_columns):
             # Filter for custom types with a data function
             if (custom_type := self.customTypes.get(key)) is None:
                 continue
+            if custom_type.onDataBatch is not None:
+                if item not in self.batchData.get(key, {}):
+                    self._fetchBatch(custom_type, [item], is_notes_mode)
+                row.cells[index].text = self.batchData[key][item]
+                continue
             if custom_type.onData is None:
                 continue
 
-            # Get cell content
-            try:
-                row.cells[index].text = custom_type.onData(c, n, key)
-            except Exception as error:
-                row.cells[index].text = f"{error}"
+            cacheKey = self.cellCacheKey(custom_type, item, is_notes_mode)
+            text = cellCache.get(cacheKey) if cacheKey is not None else MISSING
+            if text is MISSING:
+                # Get cell content. Loading the card or note of the row
+                # is timed as part of the first column needing it.
+                if timings is not None:
+                    start = time.perf_counter()
+                try:
+                    if custom_type.dependencies is None:
+                        text = custom_type.onData(ctx.card, ctx.note, key)
+                    else:
+                        text = custom_type.onData(ctx, key)
+                except Exception as error:
+                    text = f"{error}"
+                else:
+                    if cacheKey is not None:
+                        cellCache.put(cacheKey, text)
+                if timings is not None:
+                    timings.addData(key, time.perf_counter() - start)
+            row.cells[index].text = text
 
             # Get rtl info for field cells
             if key.startswith("_field_"):
-                fldName = key[7:]
-                model = n.note_type()
-                model_id = model["id"]
-                if model_id not in self.modelFldObjs:
-                    self.modelFldObjs[model_id] = {}
-                if fldName not in self.modelFldObjs[model_id]:
-                    flds = [f for f in model['flds'] if f['name'] == fldName]
-                    if len(flds) == 0:
-                        # This model does not have a field with that name
-                        self.modelFldObjs[model_id][fldName] = None
-                    else:
-                        self.modelFldObjs[model_id][fldName] = flds[0]
-                fld = self.modelFldObjs[model_id][fldName]
-                row.cells[index].is_rtl = bool(fld and fld["rtl"])
+                mid = self.rowMids.get(item)
+                if mid is None:
+                    mid = ctx.note.mid
+                fld = notetypeIndex.field(mid, key[7:])
+                row.cells[index].is_rtl = bool(fld and fld.rtl)
 
     def setData(self, model, index, value, role):
         if role not in (Qt.ItemDataRole.DisplayRole, Qt.ItemDataRole.EditRole):
@@ -169,20 +468,39 @@ class AdvancedBrowser:
 
         type = model.column_at(index).key
         if type in self.customTypes:
-            r = self.customTypes[type].setData(c, value)
-            if r is True:
-                model.dataChanged.emit(index, index, [role])
+            custom_type = self.customTypes[type]
+            start = time.perf_counter()
+            if custom_type.editData is not None:
+                # Saved by an operation, after which the table reloads
+                r = bulk_edit.editCells(self, [(index.row(), type, value)], self.browser)
+            else:
+                r = custom_type.setData(c, value)
+                if r is True:
+                    model.dataChanged.emit(index, index, [role])
+            if self.timings is not None:
+                self.timings.add(type, SET_DATA, time.perf_counter() - start)
             return r
         else:
             return False
 
-    def _on_header_context(self, table, pos):
-        """Override the original onHeaderContext. We are responsible for
-        building the entire menu, so we include the original columns as
-        well."""
+    def resetContextMenu(self):
+        # The items of the header context menu, built when it's first
+        # shown and kept until the notetypes, the config or the browser
+        # mode change.
+        self.contextMenu = None
+        self._contextMenuKey = None
+        # ColumnIndex of the columns in self.contextMenu
+        self.columnIndex = None
+
+    def buildContextMenu(self, table):
+        """Return the items of the header context menu, building them
+        if needed."""
+        notetypeIndex.refresh()
+        cacheKey = (notetypeIndex.generation, dict(config.getUserOption()),
+                    table._state.is_notes_mode())
+        if self.contextMenu is not None and cacheKey == self._contextMenuKey:
+            return self.contextMenu
 
-        gpos = table._view.mapToGlobal(pos)
-        main = QMenu()
         contextMenu = ContextMenu()
 
         # We are also a client and we need to add the built-in columns first.
@@ -193,6 +511,39 @@ class AdvancedBrowser:
         # Now let clients do theirs.
         runHook("advBrowserBuildContext", contextMenu)
 
+        self.contextMenu = contextMenu
+        self._contextMenuKey = cacheKey
+        self.columnIndex = None
+        return contextMenu
+
+    def showColumnPicker(self, table):
+        contextMenu = self.buildContextMenu(table)
+        if self.columnIndex is None:
+            self.columnIndex = ColumnIndex(contextMenu)
+        ColumnPicker(self.browser, table, self.columnIndex).exec()
+
+    def _on_header_context(self, table, pos):
+        """Override the original onHeaderContext. We are responsible for
+        building the entire menu, so we include the original columns as
+        well."""
+
+        gpos = table._view.mapToGlobal(pos)
+        main = QMenu()
+        contextMenu = self.buildContextMenu(table)
+
+        main.addAction("Find column...").triggered.connect(
+            lambda: self.showColumnPicker(table))
+        main.addAction("Export rows...").triggered.connect(
+            lambda: export.exportTable(self))
+        # Statistics of the column that was right-clicked
+        section = table._view.horizontalHeader().logicalIndexAt(pos)
+        if section >= 0:
+            cc = self.customTypes.get(table._model.column_at_section(section).key)
+            if cc is not None and cc.onSort():
+                main.addAction(f"Statistics of {cc.name}...").triggered.connect(
+                    lambda: showColumnStats(self, cc))
+        main.addSeparator()
+
         def addCheckableAction(menu, type, name):
             a = menu.addAction(name)
             a.setCheckable(True)
@@ -202,7 +553,12 @@ class AdvancedBrowser:
         # For some reason, sub menus aren't added if we don't keep a
         # reference to them until exec, so keep them in this list.
         tmp = []
-        # Recursively add each item/group.
+        # Recursively add each item/group. Sub menus are only filled
+        # when they are opened.
+
+        def fillSubgroup(sub, group):
+            if sub.isEmpty():
+                addToSubgroup(sub, group.items())
 
         def addToSubgroup(menu, items):
             for item in items:
@@ -211,12 +567,20 @@ class AdvancedBrowser:
                     sub = QMenu(item.name)
                     tmp.append(sub)
                     menu.addMenu(sub)
-                    addToSubgroup(sub, item.items())
+                    sub.aboutToShow.connect(
+                        lambda sub=sub, group=item: fillSubgroup(sub, group))
                 else:
                     addCheckableAction(menu, item.type, item.name)
         # Start adding from the top
         addToSubgroup(main, contextMenu.items())
 
+        if self.timings is not None or self.slowSearchThreshold:
+            main.addSeparator()
+        if self.timings is not None:
+            main.addAction("Column timings...").triggered.connect(self.showTimings)
+        if self.slowSearchThreshold:
+            main.addAction("Slow searches...").triggered.connect(self.showSlowSearches)
+
         main.exec(gpos)
 
 
@@ -256,6 +620,8 @@ gui_hooks.browser_will_show.append(advanced_browser._load)
 gui_hooks.browser_will_search.append(advanced_browser.willSearch)
 gui_hooks.browser_did_search.append(advanced_browser.didSearch)
 gui_hooks.browser_did_fetch_row.append(advanced_browser._column_data)
+gui_hooks.browser_will_show_context_menu.append(
+    lambda browser, menu: bulk_edit.onContextMenu(advanced_browser, browser, menu))
 
 # Override table's context menu to include our own columns
 aqt.browser.Table._on_header_context = lambda *args: advanced_browser._on_header_context(*args)
@@ -0,0 +1,84 @@
+# -*- coding: utf-8 -*-
+# See github page to report issues or to contribute:
+# https://github.com/hssm/advanced-browser
+
+# Populating the cells of deferred columns (see CustomColumn) without
+# holding up the table while it paints its rows. Their cells show a
+# placeholder at first, and the values of the whole block of rows are
+# computed as a background task on Anki's collection thread. When they
+# are ready, they replace the placeholders and only those cells are
+# repainted.
+#
+# The task reads the collection through mw.col.db, so it sees every
+# change made so far, like the sort of the column does. It runs after
+# the collection tasks already queued, such as a sort table being
+# built. Results for rows the browser has reloaded in the meantime are
+# dropped.
+
+import time
+
+from aqt import mw
+
+# Text of a cell whose value is being computed
+PLACEHOLDER = "…"
+
+
+class DeferredLoader:
+
+    def __init__(self, advBrowser):
+        self.advBrowser = advBrowser
+
+    def fetch(self, custom_type, items, isNotesMode, cacheKeys):
+        """Show placeholders for the given items of a deferred column and
+        compute their values in the background. The values are stored in
+        the cell cache under cacheKeys = {id -> key}, taken before they
+        are read."""
+        adv = self.advBrowser
+        values = adv.batchData.setdefault(custom_type.type, {})
+        for item in items:
+            values[item] = PLACEHOLDER
+        # The rows the results are meant for
+        token = (adv._pageItems, adv._pageCutoff)
+
+        def task():
+            start = time.perf_counter()
+            fetched = custom_type.onDataBatch(
+                mw.col.db, items, isNotesMode, custom_type.type)
+            return fetched, time.perf_counter() - start
+
+        mw.taskman.run_in_background(
+            task, lambda future: self.onDone(
+                future, token, custom_type, items, cacheKeys),
+            uses_collection=True)
+
+    def onDone(self, future, token, custom_type, items, cacheKeys):
+        adv = self.advBrowser
+        model = adv.table._model
+        if token[0] is not model._items or token[1] != model._stale_cutoff:
+            return
+        try:
+            fetched, elapsed = future.result()
+        except Exception as error:
+            fetched = dict.fromkeys(items, f"{error}")
+        else:
+            if adv.timings is not None:
+                adv.timings.addData(custom_type.type, elapsed)
+            adv.cacheCells(fetched, cacheKeys)
+
+        values = adv.batchData.setdefault(custom_type.type, {})
+        column = model.active_column_index(custom_type.type)
+        rows = []
+        for item in items:
+            value = values[item] = fetched.get(item)
+            if column is None:
+                continue
+            # The table shows the rows it has cached
+            cached = model._rows.get(item)
+            if cached is not None:
+                cached.cells[column].text = value
+            row = adv._itemRows.get(item)
+            if row is not None:
+                rows.append(row)
+        if rows:
+            model.dataChanged.emit(model.index(min(rows), column),
+                                   model.index(max(rows), column))
@@ -0,0 +1,175 @@
+# -*- coding: utf-8 -*-
+# See github page to report issues or to contribute:
+# https://github.com/hssm/advanced-browser
+
+# Exporting the rows of the current search, in their current order and
+# with the active columns, to a CSV or TSV file.
+#
+# Rows are exported a batch at a time in between the events of the UI,
+# which stays usable, and written to the file as they are. Nothing is
+# kept from one batch to the next, so the memory used doesn't grow with
+# the number of rows, and the cells of the browser aren't touched. Batch
+# columns get one call per batch, and onData columns only load the cards
+# and notes they need, like in the browser.
+
+import csv
+import os
+
+from aqt import mw
+from aqt.browser.table import CellRow
+from aqt.qt import *
+from aqt.utils import showWarning, tooltip
+
+from .column import RowContext
+from .progress import ProgressWindow
+
+# Number of rows exported at a time
+BATCH_SIZE = 500
+
+
+# Anki wraps formatted numbers in these for display, which spreadsheets
+# would show.
+ISOLATES = str.maketrans("", "", "\u2068\u2069")
+
+
+def cellText(value):
+    return "" if value is None else f"{value}".translate(ISOLATES)
+
+
+class TableExport:
+
+    def __init__(self, advBrowser, path):
+        self.advBrowser = advBrowser
+        self.path = path
+        table = advBrowser.table
+        self.state = table._state
+        self.isNotesMode = self.state.is_notes_mode()
+        self.columns = list(self.state.active_columns)
+        # The rows of the search, in their order
+        self.items = list(table._model._items)
+        self.done = 0
+        self.file = None
+        self.progress = None
+
+    def start(self):
+        dialect = "excel-tab" if self.path.lower().endswith((".tsv", ".txt")) else "excel"
+        self.file = open(self.path, "w", encoding="utf-8", newline="")
+        self.writer = csv.writer(self.file, dialect=dialect)
+        model = self.advBrowser.table._model
+        self.writer.writerow([self.state.column_label(model.columns[key])
+                              for key in self.columns])
+        self.progress = ProgressWindow(
+            self.advBrowser.browser, "Exporting rows...", len(self.items),
+            self.cancel, self.exportBatch, 0)
+
+    def exportBatch(self):
+        if not self.advBrowser.browser.isVisible():
+            self.cancel()
+            return
+        items = self.items[self.done:self.done + BATCH_SIZE]
+        try:
+            for line in self.batchLines(items):
+                self.writer.writerow(line)
+        except Exception as error:
+            self.finish()
+            self.removeFile()
+            showWarning(f"The rows couldn't be exported: {error}",
+                        parent=self.advBrowser.browser)
+            return
+        self.done += len(items)
+        self.progress.setProgress(self.done)
+        if self.done >= len(self.items):
+            self.finish()
+            tooltip(f"Exported {self.done} rows.", parent=self.advBrowser.browser)
+
+    def batchLines(self, items):
+        """Return the cells of a batch of rows, one list per row."""
+        adv = self.advBrowser
+        col = mw.col
+        # {type -> {id -> value}}
+        batches = {}
+        for key in self.columns:
+            custom_type = adv.customTypes.get(key)
+            if custom_type is None or custom_type.onDataBatch is None:
+                continue
+            try:
+                if custom_type.deferred:
+                    batches[key] = custom_type.onDataBatch(
+                        col.db, items, self.isNotesMode, key)
+                else:
+                    batches[key] = custom_type.onDataBatch(
+                        items, self.isNotesMode, key)
+            except Exception as error:
+                batches[key] = dict.fromkeys(items, f"{error}")
+
+        lines = []
+        for item in items:
+            try:
+                row = CellRow(*col.browser_row_for_id(item))
+            except Exception:
+                # Deleted since the search
+                continue
+            ctx = RowContext(self.state, item, self.isNotesMode)
+            line = []
+            for index, key in enumerate(self.columns):
+                custom_type = adv.customTypes.get(key)
+                if custom_type is None:
+                    line.append(cellText(row.cells[index].text))
+                elif key in batches:
+                    line.append(cellText(batches[key].get(item)))
+                elif custom_type.onData is None:
+                    line.append(cellText(row.cells[index].text))
+                else:
+                    try:
+                        if custom_type.dependencies is None:
+                            value = custom_type.onData(ctx.card, ctx.note, key)
+                        else:
+                            value = custom_type.onData(ctx, key)
+                    except Exception as error:
+                        value = f"{error}"
+                    line.append(cellText(value))
+            lines.append(line)
+        return lines
+
+    def cancel(self):
+        self.finish()
+        self.removeFile()
+        tooltip("Export cancelled.", parent=self.advBrowser.browser)
+
+    def removeFile(self):
+        try:
+            os.remove(self.path)
+        except OSError:
+            pass
+
+    def finish(self):
+        if self.progress is None:
+            return
+        self.progress.close()
+        self.progress = None
+        self.file.close()
+        if self.advBrowser.export is self:
+            self.advBrowser.export = None
+
+
+def exportTable(advBrowser):
+    """Ask for a file and export the rows of the current search to it."""
+    if advBrowser.export is not None:
+        tooltip("An export is already in progress.", parent=advBrowser.browser)
+        return
+    path, filter = QFileDialog.getSaveFileName(
+        advBrowser.browser, "Export rows",
+        os.path.join(QStandardPaths.writableLocation(
+            QStandardPaths.StandardLocation.DocumentsLocation), "browser.csv"),
+        "CSV (*.csv);;TSV (*.tsv)")
+    if not path:
+        return
+    if filter.startswith("TSV") and not path.lower().endswith((".tsv", ".txt")):
+        path += ".tsv"
+    try:
+        export = TableExport(advBrowser, path)
+        export.start()
+    except OSError as error:
+        showWarning(f"{error}", parent=advBrowser.browser)
+        return
+    advBrowser.export = export
@@ -2,6 +2,7 @@
 # See github page to report issues or to contribute:
 # https://github.com/hssm/advanced-browser
 from anki.cards import Card
+from anki.notes import Note
 from anki.consts import *
 from anki.hooks import addHook, remHook
 from aqt.utils import tr
@@ -56,7 +57,8 @@ class InternalFields:
         cc = advBrowser.newCustomColumn(
             type="nid",
             name="Note ID",
-            onData=lambda c, n, t: str(n.id),
+            onData=lambda ctx, t: str(ctx.noteId),
+            dependencies=(),
             onSort=lambda: "n.id asc nulls last",
             setData=setData,
         )
@@ -103,14 +105,11 @@ class InternalFields:
         )
         self.noteColumns.append(cc)
 
-        def setData(c: Card, value: str):
-            n = c.note()
+        def editData(c: Card, n: Note, value: str):
             fields = value.split(u"\u25A0")
             if len(fields) != len(n.fields):
                 return False
             n.fields = fields
-            n.flush()
-            advBrowser.editor.loadNote()
             return True
 
         cc = advBrowser.newCustomColumn(
@@ -118,7 +117,7 @@ class InternalFields:
             name="Note Fields",
             onData=lambda c, n, t: u"\u25A0".join(n.fields),
             onSort=lambda: "n.flds asc nulls last",
-            setData=setData,
+            editData=editData,
         )
         self.noteColumns.append(cc)
 
@@ -156,7 +155,8 @@ class InternalFields:
         cc = advBrowser.newCustomColumn(
             type="cid",
             name="Card ID",
-            onData=lambda c, n, t: str(c.id),
+            onData=lambda ctx, t: str(ctx.cardId),
+            dependencies=(),
             onSort=lambda: "c.id asc nulls last",
             setData=setData,
         )
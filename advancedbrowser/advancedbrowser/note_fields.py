@@ -1,148 +1,207 @@
 # -*- coding: utf-8 -*-
 # See github page to report issues or to contribute:
 # https://github.com/hssm/advanced-browser
+import os
 import re
+from concurrent.futures import ThreadPoolExecutor
+
 from anki.cards import Card
+from anki.notes import Note
 from anki.hooks import addHook
 from anki.utils import pointVersion
 from aqt import *
-from aqt.utils import showWarning
 
-from .config import getEachFieldInSingleList
+from .config import getEachFieldInSingleList, getParallelNormalizationThreshold
+from .notetype_index import notetypeIndex
+from .sort_tables import sortTables, noteSignature, notetypeSignature
 
 
 class NoteFields:
 
+    def __init__(self):
+        # The (mid, ord) pairs each field sort table was last brought up
+        # to date with. Kept across browser sessions like the tables.
+        # {table -> {(mid, ord)}}
+        self.fieldTablePairs = {}
+        # Sub-menus of the notetypes and the notetype modification time
+        # and name they were made for. Kept as long as these don't change.
+        # {mid -> ((mtime, name), ContextMenu)}
+        self.notetypeMenus = {}
+
     def onAdvBrowserLoad(self, advBrowser):
         # Dictionary of field names indexed by "type" name. Used to
         # figure out if the requested column is a note field.
         # {type -> name}
         self.fieldTypes = {}
 
-        # Dictionary of dictionaries to get position for field in model.
-        # We build this dictionary once to avoid needlessly finding the
-        # field order for every single row when sorting. It's
-        # significantly faster that way.
-        # {mid -> {fldName -> pos}}
-        self.modelFieldPos = {}
-
         # Dictionary of columns. A column can exist in multiple places, because
         # different note types may have the same field name.
         # {fld['name'] -> CustomColumn}}
         self.customColumns = {}
 
-        self.fieldsToMidOrdPairs = {}
+        # The generation of the notetype index the mappings were built
+        # from
+        self.generation = None
 
         self.advBrowser = advBrowser
         self.buildMappings()
 
     def onBuildContextMenu(self, contextMenu):
-        # Models might have changed so rebuild our mappings.
-        # E.g., a field or note type could have been deleted.
+        # Models might have changed so update our mappings.
+        # E.g., a field or note type could have been added.
         self.buildMappings()
 
         # Create a new sub-menu for our columns
-        fldGroup = contextMenu.newSubMenu(" - Fields -")
         if getEachFieldInSingleList():
             # And an option for each fields
-            for model in mw.col.models.all():
-                for fld in model['flds']:
-                    fldGroup.addItem(self.customColumns[fld['name']])
+            def populate(menu):
+                for name in notetypeIndex.fieldPairs:
+                    menu.addItem(self.customColumns[name])
+            contextMenu.newSubMenu(" - Fields -", populate=populate)
         else:
-            # And a sub-menu for each note type
-            for model in mw.col.models.all():
-                modelGroup = fldGroup.newSubMenu(model['name'])
-                for fld in model['flds']:
-                    modelGroup.addItem(self.customColumns[fld['name']])
+            # And a sub-menu for each note type, filled when opened
+            fldGroup = contextMenu.newSubMenu(" - Fields -")
+            menus = {}
+            for mid, name in notetypeIndex.names.items():
+                key = (notetypeIndex.mtimes[mid], name)
+                if mid in self.notetypeMenus and self.notetypeMenus[mid][0] == key:
+                    menu = self.notetypeMenus[mid][1]
+                    fldGroup.addItem(menu)
+                else:
+                    def populate(menu, mid=mid):
+                        for name in notetypeIndex.fields[mid]:
+                            menu.addItem(self.customColumns[name])
+                    menu = fldGroup.newSubMenu(name, populate=populate)
+                menus[mid] = (key, menu)
+            self.notetypeMenus = menus
 
     def buildMappings(self):
-        self.fieldsToMidOrdPairs = {}
-        for model in mw.col.models.all():
-            # For some reason, some mids return as unicode, so convert to int
-            mid = int(model['id'])
-            # And some platforms get a signed 32-bit integer from SQlite, so
-            # we will also provide an index to that as a workaround.
-            mid32 = (mid + 2**31) % 2**32 - 2**31
-            self.modelFieldPos[mid] = {}
-            self.modelFieldPos[mid32] = {}
-            # For each field in this model, store the ordinal of the
-            # field with the field name as the key.
-            for field in model['flds']:
-                name = field['name']
-                ord = field['ord']
-                type = "_field_"+name  # prefix to avoid potential clashes
-                self.modelFieldPos[mid][name] = ord
-                self.modelFieldPos[mid32][name] = ord
-                if type not in self.fieldTypes:  # avoid dupes
-                    self.fieldTypes[type] = name
-                self.fieldsToMidOrdPairs.setdefault(
-                    name, []).append((mid, ord))
-
-        def fldOnData(c, n, t):
-            field = self.fieldTypes[t]
-            if field in c.note().keys():
-                return NoteFields.htmlToTextLine(c.note()[field])
-
-        def setData_(name):
-            def setData(c: Card, value: str):
-                n = c.note()
+        notetypeIndex.refresh()
+        if self.generation == notetypeIndex.generation:
+            return
+        self.generation = notetypeIndex.generation
+        for name in notetypeIndex.fieldPairs:
+            type = "_field_"+name  # prefix to avoid potential clashes
+            if type not in self.fieldTypes:  # avoid dupes
+                self.fieldTypes[type] = name
+
+        def fldOnData(ctx, t):
+            note = ctx.note
+            field = notetypeIndex.field(note.mid, self.fieldTypes[t])
+            if field is not None:
+                return NoteFields.htmlToTextLine(note.fields[field.ord])
+
+        def editData_(name):
+            def editData(c: Card, n: Note, value: str):
                 m = n.note_type()
                 if not name in n:
-                    showWarning(_("""The field "%s" does not belong to the note type "%s".""") % (
-                        name, m["name"]))
-                    return False
-                self.advBrowser.editor.loadNote()
+                    return f"""The field "{name}" does not belong to the note type "{m['name']}"."""
                 n[name] = value
                 return True
-            return setData
+            return editData
 
+        newTypes = []
         for type, name in self.fieldTypes.items():
             if name not in self.customColumns:
                 def sortTableFunction(name=name):
-                    col = mw.col
-                    vals = []
-                    col.db.execute("drop table if exists tmp")
-                    col.db.execute(
-                        "create temp table tmp (nid int primary key, fld text)")
-                    for mid, ord in self.fieldsToMidOrdPairs.get(name):
-                        notes = mw.col.db.all(
-                            f"select id, field_at_index(flds, {ord}) from notes where mid = {mid}"
-                        )
-                        for note in notes:
-                            id = note[0]
-                            val = NoteFields.htmlToTextLine(note[1])
-                            if not val:
-                                val = None
-                            vals.append([id, val])
-                    mw.col.db.executemany(
-                        "insert into tmp values (?,?)", vals
-                    )
-
-                select = "(select fld from tmp where nid = n.id)"
-                srt = (
-                    f"""
-                    case when {select} glob '*[^0-9.]*' then {select} else cast({select} AS real) end
-                    collate nocase asc nulls last
-                    """
-                )
+                    notetypeIndex.refresh()
+                    sortTables.ensure(
+                        "field:" + name,
+                        "(nid integer primary key, mid integer, mod integer, fld text, k)",
+                        (notetypeSignature(), noteSignature()),
+                        fill=lambda table: self.updateFieldTable(table, name, True),
+                        update=lambda table: self.updateFieldTable(table, name, False))
 
                 cc = self.advBrowser.newCustomColumn(
                     type=type,
                     name=name,
                     onData=fldOnData,
+                    dependencies=("note",),
+                    cache=(),
                     sortTableFunction=sortTableFunction,
-                    onSort=lambda: srt,
-                    setData=setData_(name),
+                    onSort=lambda name=name: self.fieldSortClause(name),
+                    editData=editData_(name),
+                    searchValue=NoteFields.fieldSearchValue,
                 )
                 self.customColumns[name] = cc
-        self.advBrowser.setupColumns()
+                newTypes.append(type)
+        self.advBrowser.setupColumns(newTypes)
+
+    def updateFieldTable(self, table, name, isNew):
+        """Bring the sort table of a field up to date. Only notes that
+        were modified since their value was stored, or whose (mid, ord)
+        pair is new to this field, are normalized again."""
+        db = mw.col.db
+        pairs = set(notetypeIndex.fieldPairs.get(name, []))
+        old = set() if isNew else self.fieldTablePairs.get(table, set())
+        self.fieldTablePairs.pop(table, None)
+
+        # Note types that lost the field or moved it to another ord
+        for mid, ord in old - pairs:
+            db.execute(f"delete from {table} where mid = ?", mid)
+        # Notes that were deleted or changed to another note type
+        db.execute(f"""
+        delete from {table} where not exists (
+          select 1 from notes where notes.id = {table}.nid and notes.mid = {table}.mid)""")
+
+        pending = []
+        for mid, ord in pairs:
+            sortTables.checkpoint()
+            fld = f"field_at_index(flds, {ord})"
+            where = f"mid = {mid}"
+            if (mid, ord) in old:
+                where += f"""
+                and not exists (select 1 from {table}
+                                where nid = notes.id and mod = notes.mod)"""
+            # Without markup, htmlToTextLine only strips whitespace,
+            # which SQLite can do on its own.
+            db.execute(
+                f"""insert or replace into {table} (nid, mid, mod, fld)
+                select id, mid, mod, nullif(trim({fld}, ?), '')
+                from notes where {where} and not {fld} glob ?""",
+                WHITESPACE, MARKUP_GLOB
+            )
+            pending.extend(db.all(
+                f"select id, mid, mod, {fld} from notes where {where} and {fld} glob ?",
+                MARKUP_GLOB))
+
+        pending.sort()
+        values = NoteFields.htmlToTextLines([row[3] for row in pending])
+        sortTables.checkpoint()
+        db.executemany(
+            f"insert or replace into {table} (nid, mid, mod, fld) values (?,?,?,?)",
+            [(id, mid, mod, val or None)
+             for (id, mid, mod, _), val in zip(pending, values)]
+        )
+
+        # Sort keys of the rows stored above. Values made of digits and
+        # dots sort as numbers, before any text. ASCII text without digits
+        # is folded in SQL; other text needs naturalSortKey.
+        db.execute(f"""
+        update {table} set k = case
+          when fld not glob '*[^0-9.]*' then cast(fld as real)
+          when not (fld glob '*[0-9]*' or fld glob '*[^ -~]*') then lower(fld)
+        end
+        where k is null and fld is not null""")
+        db.executemany(
+            f"update {table} set k = ? where nid = ?",
+            [(NoteFields.naturalSortKey(fld), nid) for nid, fld in db.all(
+                f"select nid, fld from {table} where k is null and fld is not null")]
+        )
+        self.fieldTablePairs[table] = pairs
+
+    def fieldSortClause(self, fieldName):
+        """ORDER BY clause of a field column, which reads the field's
+        sort table."""
+        table = sortTables.tableName("field:" + fieldName)
+        return f"(select k from {table} where nid = n.id) asc nulls last"
 
     def getSortClause(self, fieldName: str) -> str:
         def tuple_to_str(tup) -> str:
             (ntid, ord) = tup
             return f"when n.mid = {ntid} then field_at_index(n.flds, {ord})"
 
-        tups = self.fieldsToMidOrdPairs.get(fieldName, [])
+        tups = notetypeIndex.fieldPairs.get(fieldName, [])
         if not tups:
             # no such field
             return "false"
@@ -150,6 +209,46 @@ class NoteFields:
         whenBody = " ".join(map(tuple_to_str, tups))
         return f"(case {whenBody} else null end) collate nocase asc nulls last"
 
+    def naturalSortKey(s):
+        """Case-insensitive text key in which numbers compare by value,
+        so that "9" sorts before "10"."""
+        return reDigits.sub(
+            lambda m: m.group().rjust(NATURAL_SORT_WIDTH, "0"), s.casefold())
+
+    def fieldSearchValue(value):
+        """The sort key of a value searched for in a field column, as
+        updateFieldTable computes it."""
+        if isinstance(value, (int, float)):
+            return float(value)
+        return NoteFields.naturalSortKey(NoteFields.htmlToTextLine(value))
+
+    def htmlToTextLines(values):
+        """htmlToTextLine over a list of values. Above a configurable
+        number of values, they are split into chunks that are normalized
+        by a pool of threads, and merged back in their original order.
+        Threads suffice because the HTML stripping runs in Anki's
+        backend, which releases the GIL. Progress is reported to
+        sortTables after each chunk."""
+        def normalize(chunk):
+            sortTables.checkpoint()
+            return [NoteFields.htmlToTextLine(value) for value in chunk]
+
+        chunks = [values[i:i + NORMALIZATION_CHUNK_SIZE]
+                  for i in range(0, len(values), NORMALIZATION_CHUNK_SIZE)]
+        result = []
+        threshold = getParallelNormalizationThreshold()
+        if not threshold or len(values) < threshold:
+            for chunk in chunks:
+                result.extend(normalize(chunk))
+                sortTables.checkpoint(len(result), len(values))
+            return result
+
+        with ThreadPoolExecutor(max_workers=os.cpu_count()) as executor:
+            for chunk in executor.map(normalize, chunks):
+                result.extend(chunk)
+                sortTables.checkpoint(len(result), len(values))
+        return result
+
     # Based on the one in utils.py, but keep media file names
     def htmlToTextLine(s):
         s = s.replace("<br>", " ")
@@ -165,6 +264,22 @@ class NoteFields:
 # Precompile some regexes for efficiency
 reSound = re.compile(r"\[sound:([^]]+)\]")
 reType = re.compile(r"\[\[type:[^]]+\]\]")
+reDigits = re.compile(r"[0-9]+")
+
+# Digit runs are left-padded to this width in natural sort keys
+NATURAL_SORT_WIDTH = 20
+
+# Number of values each worker normalizes at a time in parallel mode
+NORMALIZATION_CHUNK_SIZE = 10000
+
+# Matches field values that htmlToTextLine does more to than strip(): any
+# tag, entity, sound/type reference or newline. The others are normalized
+# in SQL by trimming the characters str.strip() does, i.e. those for which
+# str.isspace() is true.
+MARKUP_GLOB = "*[<&[\n]*"
+WHITESPACE = ("\t\n\x0b\x0c\r\x1c\x1d\x1e\x1f \x85\xa0\u1680\u2000\u2001\u2002"
+              "\u2003\u2004\u2005\u2006\u2007\u2008\u2009\u200a\u2028\u2029"
+              "\u202f\u205f\u3000")
 
 nf = NoteFields()
 addHook("advBrowserLoaded", nf.onAdvBrowserLoad)
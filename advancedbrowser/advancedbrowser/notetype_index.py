@@ -0,0 +1,105 @@
+# -*- coding: utf-8 -*-
+# See github page to report issues or to contribute:
+# https://github.com/hssm/advanced-browser
+
+# What the columns need to know about the fields of every notetype,
+# gathered in one pass over the notetypes and shared by displaying
+# (e.g., whether a field is right-to-left) and sorting (where a field is
+# in the notes of each notetype).
+#
+# The index is rebuilt when a notetype was added, removed or modified
+# since, e.g. when a field was renamed or its RTL setting toggled. The
+# browser checks that whenever its rows are reloaded. Modification times
+# are in seconds, so operations changing a notetype also invalidate the
+# index right away.
+
+from collections import namedtuple
+
+from aqt import gui_hooks, mw
+
+from .sort_tables import notetypeSignature
+
+# Settings of a field in a notetype
+FieldInfo = namedtuple("FieldInfo", ["ord", "rtl", "font", "size"])
+
+
+def mid32(mid):
+    """Some platforms get a signed 32-bit integer from SQLite for a
+    notetype id, so the index also provides it under that value as a
+    workaround."""
+    return (mid + 2**31) % 2**32 - 2**31
+
+
+class NotetypeIndex:
+
+    def __init__(self):
+        # The collection and notetype signature the index was built from
+        self.col = None
+        self.signature = None
+        # Incremented on every rebuild, so users of the index can tell
+        # whether what they derived from it is still current.
+        self.generation = 0
+        # {mid -> notetype name}
+        self.names = {}
+        # {mid -> notetype modification time}
+        self.mtimes = {}
+        # {mid -> {field name -> FieldInfo}} with fields in the order of
+        # the notetype, also under mid32(mid)
+        self.fields = {}
+        # Where each field name is found, in the order of the notetypes.
+        # {field name -> [(mid, ord)]}
+        self.fieldPairs = {}
+
+    def refresh(self):
+        """Rebuild the index if the notetypes changed since it was built.
+        Return whether it was rebuilt."""
+        signature = notetypeSignature()
+        if mw.col is self.col and signature == self.signature:
+            return False
+        self.rebuild()
+        self.col = mw.col
+        self.signature = signature
+        return True
+
+    def invalidate(self):
+        self.signature = None
+
+    def rebuild(self):
+        # May run on the collection thread while the main thread reads
+        # the index, so the new one is built aside and swapped in whole.
+        names = {}
+        mtimes = {}
+        allFields = {}
+        fieldPairs = {}
+        for model in mw.col.models.all():
+            # For some reason, some mids return as unicode, so convert to int
+            mid = int(model['id'])
+            names[mid] = model['name']
+            mtimes[mid] = model['mod']
+            fields = {}
+            for field in model['flds']:
+                name = field['name']
+                fields[name] = FieldInfo(
+                    field['ord'], bool(field.get('rtl')),
+                    field.get('font'), field.get('size'))
+                fieldPairs.setdefault(name, []).append((mid, field['ord']))
+            allFields[mid] = fields
+            allFields[mid32(mid)] = fields
+        self.names, self.mtimes, self.fields, self.fieldPairs = (
+            names, mtimes, allFields, fieldPairs)
+        self.generation += 1
+
+    def field(self, mid, name):
+        """Return the FieldInfo of a field of a notetype, or None if the
+        notetype has no such field."""
+        fields = self.fields.get(mid)
+        return fields.get(name) if fields is not None else None
+
+
+def onOperationDidExecute(changes, handler):
+    if changes.notetype:
+        notetypeIndex.invalidate()
+
+
+notetypeIndex = NotetypeIndex()
+gui_hooks.operation_did_execute.append(onOperationDidExecute)
@@ -0,0 +1,43 @@
+# -*- coding: utf-8 -*-
+# See github page to report issues or to contribute:
+# https://github.com/hssm/advanced-browser
+
+# The progress window of the work this add-on does in between the events
+# of the browser, like building a sort table or exporting rows. It isn't
+# modal, so the browser stays usable, e.g. to search for something else,
+# and a timer calls back while it is shown to do the work or report on it.
+
+from aqt.qt import *
+
+
+class ProgressWindow:
+
+    def __init__(self, parent, label, maximum, onCancel, onTimer, interval):
+        """Show a progress window with a Cancel button calling onCancel,
+        and call onTimer every interval milliseconds until it's closed.
+        A maximum of 0 shows a busy indicator."""
+        self.onCancel = onCancel
+        dialog = QProgressDialog(label, "Cancel", 0, maximum, parent)
+        dialog.setWindowTitle("Advanced Browser")
+        dialog.setWindowModality(Qt.WindowModality.NonModal)
+        dialog.setMinimumDuration(0)
+        dialog.setAutoClose(False)
+        dialog.setAutoReset(False)
+        dialog.canceled.connect(onCancel)
+        self.timer = QTimer(dialog)
+        self.timer.timeout.connect(onTimer)
+        self.timer.start(interval)
+        self.dialog = dialog
+        dialog.show()
+
+    def setProgress(self, done, total=None):
+        if total is not None:
+            self.dialog.setMaximum(total)
+        self.dialog.setValue(done)
+
+    def close(self):
+        self.timer.stop()
+        # Closing it would emit canceled
+        self.dialog.canceled.disconnect(self.onCancel)
+        self.dialog.close()
+        self.dialog.deleteLater()
@@ -0,0 +1,237 @@
+# -*- coding: utf-8 -*-
+# See github page to report issues or to contribute:
+# https://github.com/hssm/advanced-browser
+
+# A per-card summary of the review log, kept in a temporary table for the
+# whole collection session. Sorting by a revlog column reads from this
+# table instead of aggregating the revlog of each card again, and so do
+# its cells, in the background (see deferred.py), so that they always
+# agree with the sort. The revlog columns of a page share one read.
+#
+# In notes mode, the columns summarize the reviews of all cards of a
+# note. They then read a second table with a row per note, derived from
+# the per-card table whenever the latter changed.
+#
+# The table remembers the highest revlog id it has seen (the watermark).
+# New reviews always get higher ids, so bringing the table up to date
+# only needs to fold in the revlog entries above the watermark. Anything
+# else (a sync bringing older reviews, a deleted review, a changed card
+# id) is caught by comparing the count and cid sum of the entries below
+# the watermark, and the table is then rebuilt from scratch. The cids are
+# summed modulo a prime so that the sum stays an exact integer. As that
+# comparison scans the whole revlog, it is only done once after something
+# could have changed old reviews: a sync, an operation changing cards, or
+# the browser being opened.
+
+from collections import namedtuple
+
+from anki.utils import ids2str
+from aqt import gui_hooks, mw
+
+TABLE = "advbrowse_revlog_stats"
+NOTE_TABLE = "advbrowse_revlog_note_stats"
+
+CID_SUM = "coalesce(sum(cid % 1000000007), 0)"
+
+# Aggregate the revlog entries above a watermark by card. The entries are
+# numbered from the most recent so that the last two reviews can be picked
+# out of the same group. The result is merged into existing rows: ids and
+# times only grow, so sums add up, extremes are compared, and the last
+# review of the new entries replaces the stored one.
+FOLD_SQL = f"""
+insert into {TABLE} (cid, first, last, cnt, totTime, fastTime, slowTime,
+                     againCount, lastTime, lastIvl, prevIvl)
+select cid, min(id), max(id), count(), sum(time), min(time), max(time),
+       sum(ease = 1), max(case when rn = 1 then time end),
+       max(case when rn = 1 then ivl end), max(case when rn = 2 then ivl end)
+from (select cid, id, ease, ivl, time,
+             row_number() over (partition by cid order by id desc) as rn
+      from revlog where id > ? and id <= ?)
+group by cid
+on conflict (cid) do update set
+  last = excluded.last,
+  cnt = cnt + excluded.cnt,
+  totTime = totTime + excluded.totTime,
+  fastTime = min(fastTime, excluded.fastTime),
+  slowTime = max(slowTime, excluded.slowTime),
+  againCount = againCount + excluded.againCount,
+  lastTime = excluded.lastTime,
+  lastIvl = excluded.lastIvl,
+  prevIvl = case when excluded.cnt > 1 then excluded.prevIvl else lastIvl end
+"""
+
+
+# Review statistics of a card. Times are in milliseconds, ids are revlog
+# ids (i.e., timestamps in milliseconds).
+RevlogStats = namedtuple("RevlogStats", [
+    "first", "last", "avgTime", "totTime", "fastTime", "slowTime",
+    "againCount", "lastTime", "prevIvl"])
+
+NO_STATS = RevlogStats(*[None] * len(RevlogStats._fields))
+
+# Fill the per-note table from the per-card one. The last review of a
+# note gives its last time, and the interval its card had before that
+# review gives its previous interval.
+NOTE_FILL_SQL = f"""
+insert into {NOTE_TABLE} (nid, first, last, cnt, totTime, fastTime, slowTime,
+                          againCount, lastTime, prevIvl)
+select nid, min(first), max(last), sum(cnt), sum(totTime), min(fastTime),
+       max(slowTime), sum(againCount), max(case when rn = 1 then lastTime end),
+       max(case when rn = 1 then prevIvl end)
+from (select c.nid, s.first, s.last, s.cnt, s.totTime, s.fastTime,
+             s.slowTime, s.againCount, s.lastTime, s.prevIvl,
+             row_number() over (partition by c.nid order by s.last desc) as rn
+      from {TABLE} s join cards c on c.id = s.cid)
+group by nid
+"""
+
+# The summary of some cards, or notes, as read from the tables
+STATS_SQL = """
+select {key}, first, last, totTime * 1.0 / cnt, totTime, fastTime, slowTime,
+       againCount, lastTime, prevIvl
+from {table} where {key} in {ids}
+"""
+
+
+class ReviewStats:
+
+    def __init__(self):
+        # Highest revlog id folded into the table
+        self.watermark = 0
+        # Number of revlog entries and checksum of their cids up to the
+        # watermark, to notice changes below it.
+        self.count = 0
+        self.cidSum = 0
+        # The state of the per-card table and the number of cards the
+        # per-note table was filled with
+        self.noteState = None
+        # Whether the entries below the watermark were compared since
+        # they could last have changed
+        self.checked = False
+        # The stats last read by readStats(), and the state of the
+        # tables they were read from
+        self.readKey = None
+        self.read = {}
+
+    def invalidate(self, *args):
+        """Have the next refresh look for changes below the watermark."""
+        self.checked = False
+
+    def refresh(self, thorough=False):
+        """Bring the table up to date with the revlog. Changes below the
+        watermark need a scan of the revlog, which is only done by a
+        thorough refresh or the first refresh after invalidate()."""
+        db = mw.col.db
+        if not db.scalar(
+                "select count() from temp.sqlite_master where name = ?", TABLE):
+            # New session or collection
+            self.rebuild()
+            return
+        maxId = db.scalar("select max(id) from revlog") or 0
+        if maxId < self.watermark:
+            self.rebuild()
+            return
+        if thorough or not self.checked:
+            count, cidSum = db.first(
+                f"select count(), {CID_SUM} from revlog where id <= ?",
+                self.watermark)
+            self.checked = True
+            if count != self.count or cidSum != self.cidSum:
+                self.rebuild()
+                return
+        if maxId > self.watermark:
+            self._fold()
+
+    def rebuild(self):
+        db = mw.col.db
+        db.execute(f"drop table if exists temp.{TABLE}")
+        db.execute(f"""
+        create temp table {TABLE} (
+          cid integer primary key,
+          first integer, last integer, cnt integer, totTime integer,
+          fastTime integer, slowTime integer, againCount integer,
+          lastTime integer, lastIvl integer, prevIvl integer)""")
+        self.watermark = 0
+        self.count = 0
+        self.cidSum = 0
+        self.checked = True
+        self.readKey = None
+        self._fold()
+
+    def _fold(self):
+        db = mw.col.db
+        maxId, count, cidSum = db.first(
+            f"select max(id), count(), {CID_SUM} from revlog where id > ?",
+            self.watermark)
+        if not count:
+            return
+        db.execute(FOLD_SQL, self.watermark, maxId)
+        self.watermark = maxId
+        self.count += count
+        self.cidSum += cidSum
+
+    def refreshNotes(self):
+        """Bring the per-note table up to date with the per-card one,
+        which must be refreshed first."""
+        db = mw.col.db
+        state = (self.watermark, self.count, self.cidSum,
+                 db.scalar("select count() from cards"))
+        if state == self.noteState and db.scalar(
+                "select count() from temp.sqlite_master where name = ?", NOTE_TABLE):
+            return
+        db.execute(f"drop table if exists temp.{NOTE_TABLE}")
+        db.execute(f"""
+        create temp table {NOTE_TABLE} (
+          nid integer primary key,
+          first integer, last integer, cnt integer, totTime integer,
+          fastTime integer, slowTime integer, againCount integer,
+          lastTime integer, prevIvl integer)""")
+        db.execute(NOTE_FILL_SQL)
+        self.noteState = state
+
+    def readStats(self, ids, isNotesMode):
+        """Return {id -> RevlogStats} for the given cards, or for the
+        given notes in notes mode, after bringing the tables up to date.
+        The revlog columns of a page all ask for the same rows, so the
+        rows last read are kept for the next columns as long as the
+        tables don't change."""
+        self.refresh()
+        if isNotesMode:
+            self.refreshNotes()
+        key = (isNotesMode, self.watermark, self.count, self.cidSum,
+               self.noteState if isNotesMode else None)
+        if key == self.readKey and all(id in self.read for id in ids):
+            return {id: self.read[id] for id in ids}
+        if isNotesMode:
+            sql = STATS_SQL.format(key="nid", table=NOTE_TABLE, ids=ids2str(ids))
+        else:
+            sql = STATS_SQL.format(key="cid", table=TABLE, ids=ids2str(ids))
+        stats = dict.fromkeys(ids, NO_STATS)
+        for row in mw.col.db.execute(sql):
+            stats[row[0]] = RevlogStats(*row[1:])
+        self.readKey = key
+        self.read = stats
+        return dict(stats)
+
+    def sortClause(self, expression, default=None, notesMode=False):
+        """Return an ORDER BY term for a card's value of an expression
+        over the columns of the table, or for a note's value in notes
+        mode."""
+        if notesMode:
+            select = f"(select {expression} from {NOTE_TABLE} where nid = n.id)"
+        else:
+            select = f"(select {expression} from {TABLE} where cid = c.id)"
+        if default is not None:
+            select = f"coalesce({select}, {default})"
+        return f"{select} asc nulls last"
+
+
+def onOperationDidExecute(changes, handler):
+    if changes.card:
+        reviewStats.invalidate()
+
+
+reviewStats = ReviewStats()
+gui_hooks.operation_did_execute.append(onOperationDidExecute)
+gui_hooks.sync_did_finish.append(reviewStats.invalidate)
+gui_hooks.browser_will_show.append(reviewStats.invalidate)
@@ -0,0 +1,141 @@
+# -*- coding: utf-8 -*-
+# See github page to report issues or to contribute:
+# https://github.com/hssm/advanced-browser
+
+# Runs the sortTableFunction of a column in the background, so that the
+# browser stays usable while a large sort table is built, whether the
+# search is sorted by the column or filters on it with an adv: term.
+#
+# Usually the table is up to date or quickly brought up to date, so the
+# search waits a moment for the build. If it takes longer, the search
+# shows its rows unsorted, a progress window is shown, and the search is
+# run again once the table is ready. A new search cancels a build that is
+# still running, as does the Cancel button.
+#
+# Builds run on Anki's collection thread, one at a time. The UI still
+# waits whenever it reads the collection while the build runs a long
+# statement.
+
+import threading
+import time
+from concurrent.futures import TimeoutError
+
+from aqt import mw
+from aqt.utils import showWarning
+
+from .progress import ProgressWindow
+from .sort_tables import sortTables, SortTableCancelled
+from .timing import SORT_TABLE
+
+# Seconds a search waits for a sort table before going on unsorted
+SYNC_WAIT = 0.2
+# Seconds the search run again after a background build waits for the
+# table, which is normally ready by then
+BUILT_WAIT = 2
+
+
+class SortTableBuilder:
+
+    def __init__(self, advBrowser):
+        self.advBrowser = advBrowser
+        # The build in progress: its future, column, cancel event and
+        # the text of its progress window
+        self.future = None
+        self.column = None
+        self.cancelEvent = None
+        self.label = None
+        self.progress = None
+        # Type of the column whose table was just built in the
+        # background, for the search run again right after
+        self.built = None
+
+    def prepare(self, cc, label=None):
+        """Run the sortTableFunction of a column. Return True if its table
+        is ready, or False if it's still being built, in which case the
+        search is run again when it is ready. label is the text of the
+        progress window shown meanwhile."""
+        self.cancel()
+        cancelEvent = threading.Event()
+
+        def build():
+            # Cancelled before its turn came
+            if cancelEvent.is_set():
+                raise SortTableCancelled()
+            sortTables.cancelEvent = cancelEvent
+            sortTables.progress = (0, 0)
+            start = time.perf_counter()
+            try:
+                cc.sortTableFunction()
+            finally:
+                sortTables.cancelEvent = None
+            return time.perf_counter() - start
+
+        future = mw.taskman.run_in_background(build, self.onDone)
+        # Right after a background build, the table is normally ready.
+        # Wait for it longer, so searches don't keep going on unsorted,
+        # but not so long that the browser hangs if it isn't.
+        wait = BUILT_WAIT if self.built == cc.type else SYNC_WAIT
+        self.built = None
+        try:
+            elapsed = future.result(timeout=wait)
+        except TimeoutError:
+            self.future = future
+            self.column = cc
+            self.cancelEvent = cancelEvent
+            self.label = label or f"Preparing to sort by {cc.name}..."
+            self.showProgress()
+            return False
+        self.recordTime(cc, elapsed)
+        return True
+
+    def cancel(self):
+        """Cancel the build in progress, if any."""
+        if self.future is None:
+            return
+        self.cancelEvent.set()
+        self.future = None
+        self.column = None
+        self.cancelEvent = None
+        self.hideProgress()
+
+    def onDone(self, future):
+        if future is not self.future:
+            # Cancelled, or the search waited for it
+            return
+        cc = self.column
+        self.future = None
+        self.column = None
+        self.cancelEvent = None
+        self.hideProgress()
+        try:
+            elapsed = future.result()
+        except SortTableCancelled:
+            return
+        except Exception as error:
+            showWarning(f"{error}", parent=self.advBrowser.browser)
+            return
+        self.recordTime(cc, elapsed)
+        browser = self.advBrowser.browser
+        if browser.isVisible():
+            self.built = cc.type
+            browser.search()
+
+    def recordTime(self, cc, elapsed):
+        if self.advBrowser.timings is not None:
+            self.advBrowser.timings.add(cc.type, SORT_TABLE, elapsed)
+
+    def showProgress(self):
+        self.progress = ProgressWindow(
+            self.advBrowser.browser, self.label, 0, self.cancel,
+            self.updateProgress, 100)
+
+    def updateProgress(self):
+        done, total = sortTables.progress
+        if total:
+            self.progress.setProgress(done, total)
+
+    def hideProgress(self):
+        if self.progress is None:
+            return
+        self.progress.close()
+        self.progress = None
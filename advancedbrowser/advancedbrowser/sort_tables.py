@@ -0,0 +1,104 @@
+# -*- coding: utf-8 -*-
+# See github page to report issues or to contribute:
+# https://github.com/hssm/advanced-browser
+
+# Lookup tables used by the ORDER BY clause of some columns, e.g. to sort
+# cards by the name of their deck rather than its id.
+#
+# Each table is a temporary table of its own that is kept for the whole
+# collection session. Along with a table we remember a signature of the
+# data it was built from, so a search only rebuilds it when that data has
+# changed since. Tables that can be brought up to date more cheaply than
+# by rebuilding them provide a function to do so.
+#
+# Tables may be built in the background (see sort_builder). Long fill and
+# update functions call checkpoint() from time to time to report their
+# progress and to stop when the build was cancelled.
+
+from aqt import mw
+
+TABLE_PREFIX = "advbrowse_sort_"
+
+
+def deckSignature():
+    """Changes whenever a deck is added, removed or renamed."""
+    return tuple(mw.col.db.first("select count(), max(mtime_secs) from decks"))
+
+
+def notetypeSignature():
+    """Changes whenever a notetype (including its fields and templates)
+    is added, removed or modified."""
+    return tuple(mw.col.db.first("select count(), max(mtime_secs) from notetypes"))
+
+
+def noteSignature():
+    """Changes whenever a note is added, removed or modified."""
+    return tuple(mw.col.db.first("select count(), max(mod) from notes"))
+
+
+class SortTableCancelled(Exception):
+    pass
+
+
+class SortTables:
+
+    def __init__(self):
+        # {name -> table name}
+        self.tableNames = {}
+        # {table name -> signature of the data it was built from}
+        self.signatures = {}
+        # threading.Event set to cancel the build in progress, if any
+        self.cancelEvent = None
+        # (done, total) reported by the build in progress
+        self.progress = (0, 0)
+
+    def checkpoint(self, done=0, total=0):
+        """Report the progress of a fill or update function, and raise
+        SortTableCancelled if the build was cancelled. May be called from
+        any thread."""
+        if self.cancelEvent is not None and self.cancelEvent.is_set():
+            raise SortTableCancelled()
+        self.progress = (done, total)
+
+    def tableName(self, name):
+        """Return the name of the table for a column. Column names may
+        contain anything (e.g. note field names), so tables are simply
+        numbered."""
+        if name not in self.tableNames:
+            self.tableNames[name] = f"{TABLE_PREFIX}{len(self.tableNames)}"
+        return self.tableNames[name]
+
+    def ensure(self, name, schema, signature, fill, update=None):
+        """Make sure the table for a column exists and was built from data
+        with the given signature.
+
+        schema = Table definition following "create temp table <name>".
+
+        fill = Function that fills the new, empty table. It is given the
+        table name.
+
+        update = Optional function that brings an existing table up to
+        date instead of rebuilding it. It is given the table name.
+        """
+        table = self.tableName(name)
+        exists = mw.col.db.scalar(
+            "select count() from temp.sqlite_master where name = ?", table)
+        if exists and self.signatures.get(table) == signature:
+            return table
+        self.signatures.pop(table, None)
+        try:
+            if exists and update is not None:
+                update(table)
+            else:
+                mw.col.db.execute(f"drop table if exists temp.{table}")
+                mw.col.db.execute(f"create temp table {table} {schema}")
+                fill(table)
+        except BaseException:
+            # Don't leave a half built table behind (e.g., when cancelled)
+            mw.col.db.execute(f"drop table if exists temp.{table}")
+            raise
+        self.signatures[table] = signature
+        return table
+
+
+sortTables = SortTables()
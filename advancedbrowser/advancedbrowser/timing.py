@@ -0,0 +1,163 @@
+# -*- coding: utf-8 -*-
+# See github page to report issues or to contribute:
+# https://github.com/hssm/advanced-browser
+
+# Wall times of the work the add-on does for each column, recorded when
+# the "Record column timings" option is on. They help finding out which
+# column makes the browser slow.
+#
+# The sort table and the search are recorded once per search. The data
+# of a column is fetched row by row as the table is scrolled, so its
+# time is summed up over a search and recorded as one sample when the
+# next search starts (or when a report is made). Editing a cell is
+# recorded per edit.
+#
+# Separately, searches slower than the "Slow search threshold" option
+# are kept in a log along with their ORDER BY clause and its query plan.
+
+import json
+import time
+from collections import defaultdict, deque, namedtuple
+
+SORT_TABLE = "sort table"
+SEARCH = "search"
+DATA = "data"
+SET_DATA = "set data"
+
+# Number of samples kept per column and kind of work
+MAX_SAMPLES = 1000
+
+# Number of slow searches kept
+MAX_SLOW_SEARCHES = 100
+
+
+def percentile(values, p):
+    """Nearest-rank percentile of a sorted list."""
+    index = max(0, -(-len(values) * p // 100) - 1)
+    return values[int(index)]
+
+
+class ColumnTimings:
+
+    def __init__(self):
+        self.clear()
+
+    def clear(self):
+        # {(type, kind) -> deque of milliseconds}
+        self.samples = defaultdict(lambda: deque(maxlen=MAX_SAMPLES))
+        # {(type, kind) -> number of calls}
+        self.calls = defaultdict(int)
+        # Data time of the current search.
+        # {type -> [milliseconds, calls]}
+        self.pending = {}
+
+    def add(self, type, kind, seconds, calls=1):
+        self.samples[(type, kind)].append(seconds * 1000)
+        self.calls[(type, kind)] += calls
+
+    def addData(self, type, seconds):
+        entry = self.pending.get(type)
+        if entry is None:
+            self.pending[type] = [seconds * 1000, 1]
+        else:
+            entry[0] += seconds * 1000
+            entry[1] += 1
+
+    def endSearch(self):
+        """Record the data time summed up since the last search."""
+        for type, (ms, calls) in self.pending.items():
+            self.samples[(type, DATA)].append(ms)
+            self.calls[(type, DATA)] += calls
+        self.pending = {}
+
+    def rows(self):
+        """Return (type, kind, calls, samples, p50, p95, total) for each
+        column and kind of work, slowest p95 first. Times are in
+        milliseconds."""
+        self.endSearch()
+        rows = []
+        for (type, kind), samples in self.samples.items():
+            values = sorted(samples)
+            rows.append((type, kind, self.calls[(type, kind)], len(values),
+                         percentile(values, 50), percentile(values, 95),
+                         sum(values)))
+        rows.sort(key=lambda row: row[5], reverse=True)
+        return rows
+
+    def report(self, names):
+        """Return the timings as a plain text table. names = {type ->
+        column name}."""
+        lines = [
+            "Slowest columns first. Data times are summed up per search.",
+            "",
+            f"{'Column':<30} {'Work':<10} {'Calls':>8} {'Samples':>8} "
+            f"{'p50 ms':>9} {'p95 ms':>9} {'Total ms':>10}",
+        ]
+        for type, kind, calls, count, p50, p95, total in self.rows():
+            name = names.get(type, type)
+            lines.append(
+                f"{name[:30]:<30} {kind:<10} {calls:>8} {count:>8} "
+                f"{p50:>9.1f} {p95:>9.1f} {total:>10.1f}")
+        if len(lines) == 3:
+            lines.append("Nothing recorded yet.")
+        return "\n".join(lines)
+
+
+# A search that took longer than the "Slow search threshold". order is
+# the ORDER BY clause given to Anki (None when sorting by a built-in
+# column) and plan the EXPLAIN QUERY PLAN rows of a search of the whole
+# collection sorted by it.
+SlowSearch = namedtuple("SlowSearch", [
+    "time", "search", "column", "order", "ms", "plan"])
+
+
+def formatPlan(plan):
+    """Indent EXPLAIN QUERY PLAN rows (id, parent, notused, detail) like
+    the sqlite3 shell does."""
+    depths = {0: -1}
+    lines = []
+    for id, parent, _, detail in plan:
+        depths[id] = depths.get(parent, -1) + 1
+        lines.append("  " * depths[id] + detail)
+    return lines
+
+
+class SlowSearchLog:
+
+    def __init__(self):
+        self.searches = deque(maxlen=MAX_SLOW_SEARCHES)
+
+    def add(self, search, column, order, ms, plan):
+        self.searches.append(
+            SlowSearch(time.time(), search, column, order, ms, plan))
+
+    def clear(self):
+        self.searches.clear()
+
+    def report(self):
+        """Return the slow searches as plain text, most recent first."""
+        if not self.searches:
+            return "No slow searches recorded yet."
+        lines = []
+        for entry in reversed(self.searches):
+            lines.append(time.strftime("%Y-%m-%d %H:%M:%S",
+                                       time.localtime(entry.time)))
+            lines.append(f"  Search:   {entry.search}")
+            lines.append(f"  Column:   {entry.column}")
+            lines.append(f"  Order by: {entry.order}")
+            lines.append(f"  Took:     {entry.ms:.0f}ms")
+            if entry.plan:
+                lines.append("  Plan:")
+                lines.extend("    " + line for line in formatPlan(entry.plan))
+            lines.append("")
+        return "\n".join(lines)
+
+    def export(self, path):
+        """Write the slow searches to a JSON file, oldest first."""
+        with open(path, "w", encoding="utf-8") as f:
+            json.dump([entry._asdict() for entry in self.searches], f,
+                      indent=1, ensure_ascii=False)
+
+
+columnTimings = ColumnTimings()
+slowSearchLog = SlowSearchLog()
@@ -0,0 +1,84 @@
+# -*- coding: utf-8 -*-
+# See github page to report issues or to contribute:
+# https://github.com/hssm/advanced-browser
+
+# A dialog to find a column by typing part of its name or of the name of
+# its notetype or group, and to show or hide it.
+
+from aqt.qt import *
+
+# Number of matches listed at a time. More are found by typing more.
+MAX_SHOWN = 300
+
+
+class ColumnPicker(QDialog):
+
+    def __init__(self, parent, table, index):
+        QDialog.__init__(self, parent)
+        self.table = table
+        self.index = index
+        self.setWindowTitle("Find column")
+        self.resize(500, 500)
+
+        self.search = QLineEdit()
+        self.search.setPlaceholderText("Type part of a column, notetype or group name")
+        self.search.textChanged.connect(self.update)
+        self.list = QListWidget()
+        self.list.itemChanged.connect(self.onItemChanged)
+        self.list.itemActivated.connect(self.onItemActivated)
+        self.status = QLabel()
+
+        layout = QVBoxLayout()
+        layout.addWidget(self.search)
+        layout.addWidget(self.list)
+        layout.addWidget(self.status)
+        self.setLayout(layout)
+
+        # Enter in the search box toggles the first match
+        self.search.returnPressed.connect(self.toggleFirst)
+        self.update()
+
+    def update(self):
+        entries = self.index.search(self.search.text())
+        model = self.table._model
+        self.list.blockSignals(True)
+        self.list.setUpdatesEnabled(False)
+        self.list.clear()
+        for entry in entries[:MAX_SHOWN]:
+            text = entry.name
+            if entry.groups:
+                groups = ", ".join(entry.groups[:3])
+                if len(entry.groups) > 3:
+                    groups += f", ... ({len(entry.groups)})"
+                text += f"    ({groups})"
+            item = QListWidgetItem(text)
+            item.setData(Qt.ItemDataRole.UserRole, entry.type)
+            item.setFlags(item.flags() | Qt.ItemFlag.ItemIsUserCheckable)
+            active = model.active_column_index(entry.type) is not None
+            item.setCheckState(Qt.CheckState.Checked if active else Qt.CheckState.Unchecked)
+            self.list.addItem(item)
+        self.list.setUpdatesEnabled(True)
+        self.list.blockSignals(False)
+        if len(entries) > MAX_SHOWN:
+            self.status.setText(f"{len(entries)} columns, showing the first {MAX_SHOWN}")
+        else:
+            self.status.setText(f"{len(entries)} columns")
+
+    def onItemChanged(self, item):
+        type = item.data(Qt.ItemDataRole.UserRole)
+        checked = item.checkState() == Qt.CheckState.Checked
+        self.table._on_column_toggled(checked, type)
+        # The table refuses to hide its last column
+        active = self.table._model.active_column_index(type) is not None
+        if active != checked:
+            self.list.blockSignals(True)
+            item.setCheckState(Qt.CheckState.Checked if active else Qt.CheckState.Unchecked)
+            self.list.blockSignals(False)
+
+    def onItemActivated(self, item):
+        checked = item.checkState() == Qt.CheckState.Checked
+        item.setCheckState(Qt.CheckState.Unchecked if checked else Qt.CheckState.Checked)
+
+    def toggleFirst(self):
+        if self.list.count():
+            self.onItemActivated(self.list.item(0))
@@ -0,0 +1,441 @@
+"""Time every column of the add-on on a synthetic collection.
+
+Requires the anki and aqt packages of the targeted Anki version, e.g.
+`pip install aqt[qt6]==23.10`. No Anki window is opened: the add-on is
+loaded into a stand-in main window and browser.
+
+For each custom column this measures:
+- willSearchMs: AdvancedBrowser.willSearch with the column as sort order
+  (i.e. preparing its sort table), on the first and on a repeated search
+- sortMs: the search of the whole collection with the column's ORDER BY
+- pageDataMs: _column_data for a full page of rows with only that column
+  active
+- pageDataWarmMs: the same page again after a new search, from the cell cache
+  for columns using it
+The same is measured in notes mode, as notesWillSearchColdMs and so on.
+Notes have several cards each (--cards-per-note), so that columns
+summarizing all cards of a note have something to do.
+
+Results are written as JSON. When a baseline file of a previous run is
+given, columns that got slower than the tolerance allows are listed and
+the script exits with status 1.
+
+With --check, nothing is timed. Instead the add-on is checked on the
+collection, and every failure is listed with an exit status of 1:
+- cached cells of columns depending on the revlog match the values
+  read from mw.col.db after a review is added
+- the field values stored in the sort tables of field columns, which
+  are normalized in SQL when they have no markup, are those
+  htmlToTextLine returns
+- no ORDER BY clause of a column looks up cards or notes again for every
+  row, which a clause can always avoid by using c and n
+
+Examples:
+    python3 benchmark.py --size small
+    python3 benchmark.py --cards 1000000 --cards-per-note 3 --notetypes 30 \\
+        --revlog 5000000 --collection /tmp/large.anki2 --output large.json \\
+        --baseline old.json
+"""
+
+import argparse
+import concurrent.futures
+import json
+import os
+import random
+import re
+import sys
+import time
+import types
+
+SIZES = {
+    "small": dict(cards=10000, cards_per_note=2, notetypes=5, fields=4, revlog=50000),
+    "medium": dict(cards=100000, cards_per_note=2, notetypes=15, fields=6, revlog=500000),
+    "large": dict(cards=1000000, cards_per_note=2, notetypes=30, fields=8, revlog=5000000),
+}
+
+# A step of a query plan reading the cards or notes table
+reCardsOrNotesLookup = re.compile(r"(SCAN|SEARCH) (cards|notes)\b")
+
+# Some field contents with and without markup
+WORDS = ["alpha", "Beta", "gamma", "δέλτα", "日本語", "10", "9", "3.14", ""]
+MARKUP = ["<b>{}</b>", "{}<br>", "<div>{}</div>", "[sound:{}.mp3]", "{} &amp; co", "{}",
+          " {}\u00a0", "\t{}\u3000"]
+
+scriptdir = os.path.dirname(os.path.realpath(__file__))
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--size", choices=SIZES, default="small",
+                        help="preset for the collection size")
+    parser.add_argument("--cards", type=int)
+    parser.add_argument("--cards-per-note", type=int,
+                        help="cards of each note, i.e. templates of each notetype")
+    parser.add_argument("--notetypes", type=int)
+    parser.add_argument("--fields", type=int, help="fields per notetype")
+    parser.add_argument("--revlog", type=int, help="number of reviews")
+    parser.add_argument("--collection",
+                        help="collection file to reuse, created if missing")
+    parser.add_argument("--output", default="benchmark.json")
+    parser.add_argument("--baseline", help="results of a previous run")
+    parser.add_argument("--tolerance", type=float, default=0.25,
+                        help="allowed slowdown against the baseline (0.25 = 25%%)")
+    parser.add_argument("--min-difference", type=float, default=10,
+                        help="slowdowns below this many milliseconds are ignored")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--check", action="store_true",
+                        help="check the add-on instead of timing it")
+    args = parser.parse_args()
+    for key, value in SIZES[args.size].items():
+        if getattr(args, key) is None:
+            setattr(args, key, value)
+    if args.collection is None:
+        args.collection = os.path.join(
+            scriptdir, f"benchmark_{args.cards}_{args.cards_per_note}_"
+                       f"{args.notetypes}_{args.fields}_{args.revlog}.anki2")
+    return args
+
+
+def generate(col, args):
+    """Fill an empty collection with notetypes, notes, cards and reviews
+    written directly to the database."""
+    from anki.utils import field_checksum, guid64
+
+    rand = random.Random(args.seed)
+    mm = col.models
+    mids = []
+    for i in range(args.notetypes):
+        model = mm.new(f"Notetype {i}")
+        # Notetypes share some field names so that a field column spans
+        # several of them.
+        for j in range(args.fields):
+            mm.add_field(model, mm.new_field(f"Field {(i + j) % (args.fields * 2)}"))
+        for j in range(args.cards_per_note):
+            template = mm.new_template(f"Card {j + 1}")
+            template["qfmt"] = "{{%s}}" % model["flds"][j % args.fields]["name"]
+            template["afmt"] = "{{FrontSide}}"
+            mm.add_template(model, template)
+        mm.add(model)
+        mids.append(model["id"])
+
+    dids = [col.decks.id(f"Deck {i}::Sub {i % 3}") for i in range(20)]
+    now = int(time.time())
+    today = col.sched.today
+
+    def text():
+        return rand.choice(MARKUP).format(rand.choice(WORDS) + str(rand.randint(0, 999)))
+
+    base = now * 1000 - args.cards * 10
+    notes = []
+    cards = []
+    for i in range(args.cards):
+        # The first card of each note shares its id
+        ord = i % args.cards_per_note
+        nid = base + i - ord
+        if not ord:
+            flds = [text() for _ in range(args.fields)]
+            notes.append((nid, guid64(), rand.choice(mids), now - rand.randint(0, 10**6), -1,
+                          "", "\x1f".join(flds), flds[0], field_checksum(flds[0]), 0, ""))
+        type = rand.choice((0, 1, 2, 2, 2, 3))
+        ivl = rand.randint(1, 400) if type == 2 else 0
+        due = today + rand.randint(-50, 100) if type == 2 else i
+        cards.append((base + i, nid, rand.choice(dids), ord, now, -1, type, type, due, ivl,
+                      2500 if type else 0, rand.randint(0, 50), rand.randint(0, 10),
+                      0, 0, 0, rand.choice((0, 0, 0, 1, 2)), ""))
+    col.db.executemany(
+        "insert into notes values (?,?,?,?,?,?,?,?,?,?,?)", notes)
+    col.db.executemany(
+        "insert into cards values (?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?)", cards)
+
+    revlog = []
+    rid = base - args.revlog * 10
+    for i in range(args.revlog):
+        rid += rand.randint(1, 10)
+        revlog.append((rid, base + rand.randrange(args.cards), -1, rand.randint(1, 4),
+                       rand.randint(-600, 300), 0, 2500, rand.randint(500, 60000), 1))
+        if len(revlog) == 100000:
+            col.db.executemany("insert into revlog values (?,?,?,?,?,?,?,?,?)", revlog)
+            revlog = []
+    col.db.executemany("insert into revlog values (?,?,?,?,?,?,?,?,?)", revlog)
+
+
+class BenchAddonManager:
+    def getConfig(self, module):
+        with open(os.path.join(scriptdir, "advancedbrowser", "config.json")) as f:
+            config = json.load(f)
+        config["Show internal fields"] = True
+        return config
+
+    def setConfigUpdatedAction(self, module, action):
+        pass
+
+
+class BenchTaskManager:
+    """Runs background tasks right away, so that sort tables are always
+    built within the search that needs them, and deferred columns get
+    their values within the page that needs them."""
+
+    def run_in_background(self, task, on_done=None, args=None, uses_collection=True):
+        future = concurrent.futures.Future()
+        try:
+            future.set_result(task(**(args or {})))
+        except Exception as error:
+            future.set_exception(error)
+        if on_done is not None:
+            self.run_on_main(lambda: on_done(future))
+        return future
+
+    def run_on_main(self, closure):
+        closure()
+
+
+class BenchModel:
+    """The parts of the browser's table model the add-on uses."""
+
+    def __init__(self):
+        self.columns = {}
+        self._items = []
+        self._stale_cutoff = 0.0
+        self._rows = {}
+
+    def active_column_index(self, column):
+        # There are no cells to repaint
+        return None
+
+
+class BenchRow:
+    def __init__(self, count):
+        self.cells = [types.SimpleNamespace(text="", is_rtl=False) for _ in range(count)]
+
+
+def load_addon(col):
+    import aqt
+    from aqt.browser.table.state import CardState
+
+    aqt.mw = types.SimpleNamespace(col=col, addonManager=BenchAddonManager(),
+                                   taskman=BenchTaskManager())
+    sys.path.insert(0, scriptdir)
+    from advancedbrowser.advancedbrowser import core
+
+    table = types.SimpleNamespace(_state=CardState(col), _model=BenchModel(), _view=None)
+    browser = types.SimpleNamespace(table=table, editor=None, col=col)
+    ab = core.advanced_browser
+    ab._load(browser)
+    return ab, core
+
+
+def timed(f, *args):
+    start = time.perf_counter()
+    result = f(*args)
+    return (time.perf_counter() - start) * 1000, result
+
+
+def run(ab, core, col):
+    from aqt.browser import SearchContext
+    from aqt.browser.table.state import CardState, NoteState
+
+    model = ab.table._model
+    results = {}
+    for key, column in sorted(ab.customTypes.items()):
+        entry = {}
+        for prefix, state, isNotesMode, find in (
+                ("", CardState, False, col.find_cards),
+                ("notes", NoteState, True, col.find_notes)):
+            ab.table._state = state(col)
+
+            def name(metric):
+                return prefix + metric[0].upper() + metric[1:] if prefix else metric
+
+            if column.onSort():
+                for run in ("Cold", "Warm"):
+                    ctx = SearchContext(search="", browser=None, order=model.columns[key])
+                    entry[name(f"willSearch{run}Ms")], _ = timed(ab.willSearch, ctx)
+                entry[name("sortMs")], ids = timed(find, "", ctx.order)
+            else:
+                ids = find("")
+
+            model._items = list(ids)
+            model._stale_cutoff = time.time()
+            page = model._items[:core.PAGE_SIZE]
+
+            def fetchPage():
+                for item in page:
+                    ab._column_data(item, isNotesMode, BenchRow(1), [key])
+            entry[name("pageDataMs")], _ = timed(fetchPage)
+            # The same rows again, as after searching again: columns with a
+            # cache get their values from it.
+            model._items = list(ids)
+            entry[name("pageDataWarmMs")], _ = timed(fetchPage)
+        ab.table._state = CardState(col)
+        results[key] = {name: round(value, 2) for name, value in entry.items()}
+        print(f"{key:>24} " + " ".join(f"{k}={v:.1f}" for k, v in entry.items()))
+    return results
+
+
+def freshValues(ab, key, items):
+    """Return {id -> value} of a column for some cards, computed without
+    the cell cache."""
+    column = ab.customTypes[key]
+    if column.deferred:
+        return column.onDataBatch(ab.mw.col.db, items, False, key)
+    return column.onDataBatch(items, False, key)
+
+
+def checkCachedCells(ab, core, col):
+    """Return a line for every cached cell of a column depending on the
+    revlog that differs from the revlog, before and after a review."""
+    model = ab.table._model
+    ids = col.find_cards("")
+    failures = []
+    for key, column in sorted(ab.customTypes.items()):
+        if column.onDataBatch is None or "revlog" not in (column.cache or ()):
+            continue
+        page = ids[:core.PAGE_SIZE]
+        # Fill the cache, then add an Again review to the first card and
+        # show the rows again, as the browser would after reviewing.
+        for step in ("before", "after"):
+            if step == "after":
+                rid = (col.db.scalar("select max(id) from revlog") or 0) + 1
+                col.db.execute(
+                    "insert into revlog values (?,?,-1,1,1,0,2500,1000,1)",
+                    rid, page[0])
+            # The second time, the values come from the cache
+            for _ in range(2):
+                model._items = list(ids)
+                model._stale_cutoff = time.time()
+                for item in page:
+                    ab._column_data(item, False, BenchRow(1), [key])
+            expected = freshValues(ab, key, page)
+            shown = ab.batchData[key]
+            failures += [f"{key} {step} a review: card {item} shows "
+                         f"{shown.get(item)!r} instead of {expected.get(item)!r}"
+                         for item in page if shown.get(item) != expected.get(item)]
+        col.db.execute("delete from revlog where id = ?", rid)
+    return failures
+
+
+def checkFieldNormalization(ab, col):
+    """Return a line for every field value whose normalized text in the
+    sort table of its column differs from htmlToTextLine's."""
+    from advancedbrowser.advancedbrowser.note_fields import NoteFields, WHITESPACE
+    from advancedbrowser.advancedbrowser.notetype_index import notetypeIndex
+    from advancedbrowser.advancedbrowser.sort_tables import sortTables
+
+    failures = []
+    # The SQL path trims what str.strip() does
+    spaces = {chr(c) for c in range(sys.maxunicode + 1) if chr(c).isspace()}
+    if spaces != set(WHITESPACE):
+        failures.append(f"WHITESPACE differs from str.isspace() by "
+                        f"{sorted(spaces ^ set(WHITESPACE))!r}")
+    for key, column in sorted(ab.customTypes.items()):
+        if not key.startswith("_field_"):
+            continue
+        column.sortTableFunction()
+        table = sortTables.tableName("field:" + column.name)
+        stored = dict(col.db.all(f"select nid, fld from {table}"))
+        mismatches = []
+        for mid, ord in notetypeIndex.fieldPairs.get(column.name, []):
+            for nid, value in col.db.all(
+                    f"select id, field_at_index(flds, {ord}) from notes where mid = ?", mid):
+                expected = NoteFields.htmlToTextLine(value) or None
+                if stored.get(nid) != expected:
+                    mismatches.append(f"{key}: note {nid} {value!r} is stored as "
+                                      f"{stored.get(nid)!r} instead of {expected!r}")
+        failures += mismatches[:5]
+        if len(mismatches) > 5:
+            failures.append(f"{key}: {len(mismatches) - 5} more values")
+    return failures
+
+
+def checkCorrelatedSorts(ab):
+    """Return a line for every column whose ORDER BY clause reads cards
+    or notes from a correlated subquery, or can't be explained."""
+    failures = []
+    for key, column in sorted(ab.customTypes.items()):
+        if column.sortTableFunction:
+            column.sortTableFunction()
+        order = column.onSort()
+        if not order:
+            continue
+        try:
+            plan = ab.explainSort(order)
+        except Exception as error:
+            failures.append(f"{key}: {error}")
+            continue
+        correlated = set()
+        for id, parent, _, detail in plan:
+            if detail.startswith("CORRELATED") or parent in correlated:
+                correlated.add(id)
+                if reCardsOrNotesLookup.match(detail):
+                    failures.append(f"{key}: the sort reads cards or notes for "
+                                    f"every row ({detail})")
+                    break
+    return failures
+
+
+def check(ab, core, col):
+    """Run every check, returning the lines of their failures."""
+    return (checkCachedCells(ab, core, col) + checkFieldNormalization(ab, col)
+            + checkCorrelatedSorts(ab))
+
+
+def compare(results, baseline, tolerance, minDifference):
+    """Return a line for every measurement slower than the baseline by
+    more than the tolerance. Small differences are ignored as noise."""
+    slower = []
+    for key, entry in results.items():
+        for name, value in entry.items():
+            old = baseline.get(key, {}).get(name)
+            if (old is not None and value > old * (1 + tolerance)
+                    and value - old > minDifference):
+                slower.append(f"{key} {name}: {old:.1f}ms -> {value:.1f}ms")
+    return slower
+
+
+def main():
+    args = parse_args()
+    import anki.lang
+    from anki.collection import Collection
+
+    anki.lang.set_lang("en")
+    created = not os.path.exists(args.collection)
+    col = Collection(args.collection)
+    if created:
+        print(f"Generating {args.collection}")
+        generate(col, args)
+
+    ab, core = load_addon(col)
+    if args.check:
+        failures = check(ab, core, col)
+        col.close()
+        for line in failures:
+            print("FAILED", line)
+        print(f"{len(failures)} failures")
+        sys.exit(1 if failures else 0)
+    results = run(ab, core, col)
+    data = {
+        "collection": {
+            "cards": col.card_count(),
+            "notes": col.note_count(),
+            "notetypes": len(col.models.all_names_and_ids()),
+            "revlog": col.db.scalar("select count() from revlog"),
+        },
+        "columns": results,
+    }
+    col.close()
+    with open(args.output, "w") as f:
+        json.dump(data, f, indent=1, sort_keys=True)
+    print(f"Results written to {args.output}")
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)["columns"]
+        slower = compare(results, baseline, args.tolerance, args.min_difference)
+        for line in slower:
+            print("SLOWER", line)
+        if slower:
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()